@@ -19,29 +19,162 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301
 # USA
 
-import sys, xapian, email.Utils, time, getopt
+import sys, xapian, time, getopt, re, errno
 import curses, curses.wrapper, curses.textpad
-import woodpecker, woodpecker.Utils
+import woodpecker, woodpecker.Data, woodpecker.Search, woodpecker.Utils
+
+# Formats for batch output
+FORMATS = ('jsonl', 'tsv', 'mbox')
+
+# How many matches to fetch from the database at a time in batch mode
+BATCH_SIZE = 500
+
+_from_re = re.compile(r'^(>*From )', re.M)
+
+def _tsv_value(value):
+    if value==None:
+        return ''
+    if value is True:
+        return '1'
+    if value is False:
+        return '0'
+    return ' '.join(str(value).replace('\t', ' ').splitlines())
+
+def _mbox_text(text):
+    """
+    A raw message ready to go in an mbox. Messages from mboxes already
+    have their From_ line; ones from Maildirs need one, and their body
+    lines quoting (mboxrd style).
+    """
+    if not text.startswith('From '):
+        text = 'From MAILER-DAEMON %s\n%s' % (time.asctime(time.gmtime()), _from_re.sub(r'>\1', text))
+    if not text.endswith('\n'):
+        text += '\n'
+    if not text.endswith('\n\n'):
+        text += '\n'
+    return text
+
+def write_results(searcher, format, fields, limit=None, out=sys.stdout):
+    """
+    Write every match for the searcher's current query to out, or the
+    first limit of them. We go through the matches BATCH_SIZE at a
+    time and write each as soon as we have it.
+
+    Sorted by date without collapsing threads, each batch carries on
+    from the date the last one ended on, so Xapian only keeps a batch
+    of candidates however far in we are (it still looks at every match
+    left each time, so a run over very many takes a while). Otherwise
+    each batch asks for the next offset, and Xapian has to keep and
+    sort everything up to there, so later batches are slower and bigger:
+    the whole run costs about matches squared over BATCH_SIZE.
+    """
+    try:
+        import json
+    except ImportError:
+        import simplejson as json
+    logger = woodpecker.Utils.Logger(True)
+    by_date = searcher.sort==woodpecker.Search.SORT_DATE and not searcher.collapse and not searcher.query.empty()
+    offset = 0
+    # the date of the last match we wrote, and how many we've written
+    # with that date
+    latest = None
+    ties = 0
+    while limit==None or offset < limit:
+        wanted = BATCH_SIZE
+        if limit!=None:
+            wanted = min(wanted, limit - offset)
+        if by_date and latest:
+            # skipping those with the same date we've already written,
+            # which come first again
+            mset = searcher.get_mset_until(latest, ties, wanted)
+        else:
+            # including once we're on to those without a date
+            mset = searcher.get_mset(offset, wanted)
+        for m in mset:
+            date = m.document.get_value(woodpecker.VALUE_UTCDATETIME)
+            if date==latest:
+                ties += 1
+            else:
+                latest = date
+                ties = 1
+            if format=='mbox':
+                try:
+                    out.write(_mbox_text(woodpecker.Utils.get_message(m.document, True)))
+                except woodpecker.WoodpeckerError, e:
+                    logger.log("Skipping document %i: %s\n", m.docid, e)
+                continue
+            row = searcher.row(m, fields)
+            if format=='jsonl':
+                obj = {}
+                for (field, value) in zip(fields, woodpecker.Search.jsonable(row)):
+                    obj[field] = value
+                out.write(json.dumps(obj) + '\n')
+            else:
+                out.write('\t'.join(map(_tsv_value, row)) + '\n')
+        offset += mset.size()
+        if mset.size() < wanted:
+            if not (by_date and latest):
+                break
+            # any left are those without a date
+            by_date = False
+
+class ResultPage:
+    """
+    One page of results, with its documents already fetched, so that
+    redrawing it doesn't go back to the database.
+    """
+    def __init__(self, mset, offset):
+        self.offset = offset
+        self.estimated = mset.get_matches_estimated()
+        self.rows = []
+        for m in mset:
+            doc = m.document
+            # pull the data and value in now, rather than when we draw
+            doc.get_data()
+            doc.get_value(woodpecker.VALUE_UTCDATETIME)
+            doc.get_value(woodpecker.VALUE_THREAD)
+            self.rows.append(ResultRow(m.rank, m.docid, doc, m.collapse_count))
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def size(self):
+        return len(self.rows)
+
+    def get_matches_estimated(self):
+        return self.estimated
+
+    def row(self, rank):
+        """The row at rank, or None if it's not on this page."""
+        i = rank - self.offset
+        if i < 0 or i >= len(self.rows):
+            return None
+        return self.rows[i]
+
+class ResultRow:
+    def __init__(self, rank, docid, document, collapse_count=0):
+        self.rank = rank
+        self.docid = docid
+        self.document = document
+        # how many more from the same thread, if collapsing
+        self.collapse_count = collapse_count
 
 class QueryState:
-    def __init__(self, conf, query_string, verbose=False):
+    PAGE_CACHE_SIZE = 16
+
+    SORTS = woodpecker.Search.SORTS
+
+    def __init__(self, conf, query_string, verbose=False, shards=None):
         self.conf = conf
         self.offset = 0
         self.pagesize = 10
+        self.pages = woodpecker.Utils.LRUCache(QueryState.PAGE_CACHE_SIZE)
         self.my_addresses = []
-        self.database = self.conf.get_index()
-        self.enquire = xapian.Enquire(self.database)
-        self.qp = xapian.QueryParser()
-        self.qp.add_prefix('author', 'A')
-        self.qp.add_prefix('from', 'A')
-        self.qp.add_prefix('to', 'XT')
-        self.qp.add_prefix('subject', 'S')
-        self.qp.add_prefix('title', 'S')
-        stemmer = xapian.Stem(self.conf.get_language())
-        self.qp.set_stemmer(stemmer)
-        self.qp.set_database(self.database)
-        self.qp.set_stemming_strategy(xapian.QueryParser.STEM_SOME)
+        self.searcher = woodpecker.Search.Searcher(self.conf, shards)
         self.query_string = None
+        self.sort = None
+        self.set_sort(woodpecker.Search.SORT_RELEVANCE)
+        self.collapse = False
         self.new_query(query_string)
         self.verbose = verbose
         self.logger = woodpecker.Utils.Logger(self.verbose)
@@ -53,7 +186,7 @@ class QueryState:
     def interface(self, scr):
         class MyLogger(woodpecker.Utils.Logger):
             def __init__(self, verbose, scr):
-                self.verbose = verbose
+                woodpecker.Utils.Logger.__init__(self, verbose)
                 self.scr = scr
 
             def _log(self, message):
@@ -76,7 +209,13 @@ class QueryState:
         self.logger = self._logger
 
     def process_input(self, scr, state):
+        scr.nodelay(1)
         c = scr.getch()
+        scr.nodelay(0)
+        if c == -1:
+            # nothing typed yet, so get the next page ready while we wait
+            self.prefetch()
+            c = scr.getch()
         if state==QueryState.MESSAGE:
             if c == ord('i') or c == ord('q'):
                 return QueryState.INDEX
@@ -91,6 +230,16 @@ class QueryState:
             self.previous_page_cursor()
         elif c == ord('q') or c == ord('x'):
             sys.exit(0)
+        elif c == ord('c'):
+            self.set_collapse(not self.collapse)
+            return QueryState.INDEX
+        elif c == ord('t'):
+            self.open_thread()
+            return QueryState.INDEX
+        elif c == ord('o'):
+            i = QueryState.SORTS.index(self.sort)
+            self.set_sort(QueryState.SORTS[(i + 1) % len(QueryState.SORTS)])
+            return QueryState.INDEX
         elif c == ord('s') or c == ord('/'):
             (height, width) = scr.getmaxyx()
             scr.addstr(height-1, 0, "/ ")
@@ -113,18 +262,35 @@ class QueryState:
         scr.clear()
         (height, width) = scr.getmaxyx()
         self._header(scr)
-        for m in self.get_matches():
-            if m.rank==self.cursor:
-                break
-        if m.rank==self.cursor:
+        m = self.get_matches().row(self.cursor)
+        if m!=None:
             doc = m.document
-            d = eval(doc.get_data())
-            scr.addstr("From: %s\nTo: %s\nDate: %s\nSubject: %s\n\n%s" % (d['From'], d['To'], d['Date'], d['Title'], d['Sample']))
+            d = woodpecker.Data.decode(doc.get_data())
+            text = "From: %s\nTo: %s\nDate: %s\nSubject: %s\n\n%s" % (d['From'], d['To'], d['Date'], d['Title'], self.message_body(doc, d))
+            # leave room for the header and footer lines
+            for line in text.split('\n')[:height-4]:
+                scr.addstr(line[:width-1] + '\n')
             self.fill_string(scr, height-2, 0, d['Title'], curses.color_pair(1) | curses.A_BOLD)
-            self.fill_string(scr, height-10, 0, doc.get_data(), curses.color_pair(1) | curses.A_BOLD)
         else:
             self.fill_string(scr, height-2, 0, "Huh? Not there.", curses.color_pair(1) | curses.A_BOLD)
 
+    def message_body(self, doc, data):
+        """
+        The text of a message, fetched from its mbox; if we can't get
+        at it, fall back to the sample we stored when indexing.
+        """
+        try:
+            mess = woodpecker.Utils.get_message(doc)
+        except woodpecker.WoodpeckerError:
+            return data.get('Sample', '')
+        texts = []
+        for part in mess.walk():
+            if part.get_content_type()=='text/plain':
+                texts.append(part.get_payload(decode=True) or '')
+        if not texts:
+            return data.get('Sample', '')
+        return '\n'.join(texts)
+
     def _header(self, scr):
         self.fill_string(scr, 0, 0, "Woodpecker email browser v0.1", curses.color_pair(1) | curses.A_BOLD)
 
@@ -136,32 +302,12 @@ class QueryState:
         matches = self.get_matches()
 
         for m in matches:
-            data = eval(m.document.get_data())
-            from_bits = email.Utils.parseaddr(data['From'])
-            if from_bits[1] in self.my_addresses:
-                to_bits = email.Utils.parseaddr(data['To'])
-                if to_bits[0]!='':
-                    address = 'To ' + to_bits[0]
-                else:
-                    address = 'To ' + to_bits[1]
-            else:
-                if from_bits[0]!='':
-                    address = from_bits[0]
-                else:
-                    address = from_bits[1]
-            pdate = email.Utils.parsedate_tz(data['Date'])
-            try:
-                utcdate = email.Utils.mktime_tz(pdate)
-                utcdate_st = time.gmtime(utcdate)
-                if utcdate < time.time() - 86400 or utcdate > time.time():
-                    date_str = time.strftime("%d %b %y", utcdate_st)
-                else:
-                    date_str = time.strftime("%a %H:%m", utcdate_st)
-            except:
-                if pdate!=None:
-                    self.logger.log("erm... %s" % pdate)
-                date_str = '<no date>'
-            subject = data['Title'] or '(No subject)'
+            data = woodpecker.Data.decode(m.document.get_data(), ('FromName', 'ToName', 'Mine', 'Title'))
+            address = self.display_address(m.document, data)
+            date_str = self.display_date(m.document)
+            subject = data.get('Title') or '(No subject)'
+            if m.collapse_count > 0:
+                subject = '(+%i) %s' % (m.collapse_count, subject)
             if self.cursor!=m.rank:
                 cp = 0
             else:
@@ -178,10 +324,31 @@ class QueryState:
             scr.addstr(mid, left, text, curses.A_BOLD)
             self.fill_string(scr, height-2, 0, "No matches", curses.color_pair(1) | curses.A_BOLD)
         else:
-            self.fill_string(scr, height-2, 0, "Showing %i-%i of about %i matching emails." % (self.offset+1, self.offset+matches.size(), matches.get_matches_estimated()), curses.color_pair(1) | curses.A_BOLD)
+            self.fill_string(scr, height-2, 0, "Showing %i-%i of about %i matching emails, by %s." % (self.offset+1, self.offset+matches.size(), matches.get_matches_estimated(), self.sort), curses.color_pair(1) | curses.A_BOLD)
         # and the bottom line, the command line is blank unless needed
         scr.refresh()
 
+    def display_address(self, doc, data):
+        """
+        Who to show a result as being from (or to, if it's from us),
+        using the names worked out at index time.
+        """
+        (from_name, to_name, mine) = woodpecker.Search.correspondents(doc, data, self.my_addresses)
+        if mine:
+            return 'To ' + to_name
+        return from_name
+
+    def display_date(self, doc):
+        value = doc.get_value(woodpecker.VALUE_UTCDATETIME)
+        if value=='':
+            return '<no date>'
+        utcdate = xapian.sortable_unserialise(value)
+        utcdate_st = time.gmtime(utcdate)
+        if utcdate < time.time() - 86400 or utcdate > time.time():
+            return time.strftime("%d %b %y", utcdate_st)
+        else:
+            return time.strftime("%a %H:%M", utcdate_st)
+
     def set_pagesize(self, size):
         if size!=self.pagesize:
             self.pagesize = size
@@ -221,8 +388,39 @@ class QueryState:
         self.offset = 0
         self.cursor = 0
         self.query_string = query_string
-        query = self.qp.parse_query(self.query_string)
-        self.enquire.set_query(query)
+        # pick up anything indexed since we started
+        self.searcher.reopen()
+        self.searcher.set_query(self.searcher.parse(self.query_string))
+        self.matches = None
+
+    def set_collapse(self, collapse):
+        """Show only the best match from each thread, or not."""
+        if self.collapse==collapse:
+            return
+        self.searcher.set_collapse(collapse)
+        self.collapse = collapse
+        self.offset = 0
+        self.cursor = 0
+        self.matches = None
+
+    def open_thread(self):
+        """Replace the results with the whole thread under the cursor."""
+        m = self.get_matches().row(self.cursor)
+        if m==None:
+            return
+        thread = m.document.get_value(woodpecker.VALUE_THREAD)
+        if thread=='':
+            return
+        self.set_collapse(False)
+        self.new_query('thread:%s' % thread)
+
+    def set_sort(self, sort):
+        if self.sort==sort:
+            return
+        self.searcher.set_sort(sort)
+        self.sort = sort
+        self.offset = 0
+        self.cursor = 0
         self.matches = None
 
     def clear_matches(self):
@@ -233,9 +431,24 @@ class QueryState:
             self.offset=offset
         elif self.matches is not None:
             return self.matches
-        self.matches = self.enquire.get_mset(self.offset, self.pagesize)
+        self.matches = self.get_page(self.offset)
         return self.matches
 
+    def get_page(self, offset):
+        """Get the ResultPage starting at offset, from cache if we can."""
+        key = (self.query_string, self.sort, self.collapse, offset, self.pagesize, self.searcher.revision())
+        page = self.pages.get(key)
+        if page==None:
+            page = ResultPage(self.searcher.get_mset(offset, self.pagesize), offset)
+            self.pages.put(key, page)
+        return page
+
+    def prefetch(self):
+        """Fetch the page after the current one, if there is one."""
+        matches = self.get_matches()
+        if self.offset + self.pagesize < matches.get_matches_estimated():
+            self.get_page(self.offset + self.pagesize)
+
     def set_my_addresses(self, adrs):
         self.my_addresses = adrs
 
@@ -244,6 +457,18 @@ def usage():
     print u"Options:"
     print u"\t--help\t\tThis message"
     print u"\t--confdir d\tUse ``d'' instead of ~/.woodpecker"
+    print u"\t--sort s\tOrder by s: relevance, date (newest first) or recent"
+    print u"\t\t\t(relevance, favouring recent mail)"
+    print u"\t--threads\tShow only the best match from each thread"
+    print u"\t--format f\tDon't start the interface; write every match to"
+    print u"\t\t\tstdout as f: jsonl, tsv or mbox (the messages themselves)"
+    print u"\t--limit n\tWith --format, stop after n matches"
+    print u"\t--fields l\tWith --format jsonl or tsv, the comma-separated fields"
+    print u"\t\t\tto write (default %s)" % ','.join(woodpecker.Search.DEFAULT_ROW_FIELDS)
+    print u"\t\t\tfrom %s" % ','.join(woodpecker.Search.ROW_FIELDS)
+    print u"\t--shards l\tOnly search the comma-separated shards l"
+    print u"Restrict by date with date:YYYYMMDD..YYYYMMDD, after:YYYYMMDD or"
+    print u"before:YYYYMMDD; dates can also be YYYY or YYYYMM."
 
 def main():
     """
@@ -251,13 +476,19 @@ def main():
     """
     try:
         try:
-            optlist, args = getopt.getopt(sys.argv[1:], 'hc:v', ['help', 'confdir=', 'verbose'])
+            optlist, args = getopt.getopt(sys.argv[1:], 'hc:vs:tf:l:', ['help', 'confdir=', 'verbose', 'sort=', 'threads', 'format=', 'limit=', 'fields=', 'shards='])
         except getopt.GetoptError:
             usage()
             sys.exit(2)
 
         confdir = None
         verbose = False
+        sort = woodpecker.Search.SORT_RELEVANCE
+        collapse = False
+        format = None
+        limit = None
+        fields = woodpecker.Search.DEFAULT_ROW_FIELDS
+        shards = None
 
         for opt, arg in optlist:
             if opt in ('-h', '--help'):
@@ -267,11 +498,51 @@ def main():
                 confdir = arg
             if opt in ('-v', '--verbose'):
                 verbose = True
+            if opt in ('-s', '--sort'):
+                if arg not in QueryState.SORTS:
+                    usage()
+                    sys.exit(2)
+                sort = arg
+            if opt in ('-t', '--threads'):
+                collapse = True
+            if opt in ('-f', '--format'):
+                if arg not in FORMATS:
+                    usage()
+                    sys.exit(2)
+                format = arg
+            if opt in ('-l', '--limit'):
+                try:
+                    limit = int(arg)
+                except ValueError:
+                    usage()
+                    sys.exit(2)
+            if opt=='--fields':
+                fields = arg.split(',')
+                for field in fields:
+                    if field not in woodpecker.Search.ROW_FIELDS:
+                        usage()
+                        sys.exit(2)
+            if opt=='--shards':
+                shards = arg.split(',')
                             
         conf = woodpecker.Config(confdir)
         query_string = ' '.join(args)
-        qs = QueryState(conf, query_string, verbose)
-        qs.set_my_addresses(['james@tartarus.org'])
+        if format!=None:
+            searcher = woodpecker.Search.Searcher(conf, shards)
+            searcher.set_query(searcher.parse(query_string))
+            searcher.set_sort(sort)
+            searcher.set_collapse(collapse)
+            try:
+                write_results(searcher, format, fields, limit)
+            except IOError, e:
+                # piped into head or similar, which has had enough
+                if e.errno!=errno.EPIPE:
+                    raise
+            return
+        qs = QueryState(conf, query_string, verbose, shards)
+        qs.set_my_addresses(conf.my_addresses)
+        qs.set_sort(sort)
+        qs.set_collapse(collapse)
 
         curses.wrapper(lambda x: qs.interface(x))
     except woodpecker.WoodpeckerError, e:
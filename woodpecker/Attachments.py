@@ -0,0 +1,389 @@
+# Woodpecker attachment text extraction
+#
+# (c) Copyright James Aylett 2008
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+"""
+Getting text out of attachments (PDFs, office documents and so on) so
+it can be indexed along with the message.
+
+An extractor is a function from the attachment's bytes to text,
+registered with register() against the content types and file name
+extensions it handles. The built-in ones read OpenDocument and Office
+Open XML files directly, pass text-like attachments through, and run
+pdftotext, antiword and unrtf if they're installed. More can be added
+from Python with register(), or by listing commands in the
+'extractors' config file, one per line:
+
+  application/x-foo .foo  foo2text %s
+
+(content types and extensions it handles, then the command; %s is
+replaced by the name of a file holding the attachment, and the text
+is read from the command's stdout).
+
+Extraction runs in a small pool of worker processes, so a slow or
+stuck extractor can be given up on after its timeout without holding
+up indexing (commands are killed when they run over). Inside a
+ParallelPecker's workers, which can't have children of their own, it
+happens in-line instead.
+
+The same attachment turns up again and again, forwarded and re-sent,
+so what we extract is cached on disk keyed by the md5 of the
+attachment, and nothing gets converted twice. The cache is a file per
+attachment, written atomically, so several processes can share it. An
+extractor that fails is cached as giving no text, unless it timed out
+or couldn't be run, which might go better next time.
+"""
+
+import md5, os, re, sys, tempfile, time, zlib
+import woodpecker
+
+# Don't bother with anything bigger than this
+MAX_ATTACHMENT_BYTES = 32 * 1024 * 1024
+# or keep more text than this from any one attachment
+MAX_TEXT_BYTES = 1024 * 1024
+
+DEFAULT_TIMEOUT = 30 # seconds
+
+class Extractor:
+    def __init__(self, name, function, timeout=DEFAULT_TIMEOUT):
+        self.name = name
+        self.function = function
+        self.timeout = timeout
+
+EXTRACTORS = {} # name -> Extractor
+TYPES = {} # content type -> extractor name
+EXTENSIONS = {} # '.ext' -> extractor name
+
+def register(name, function, types=(), extensions=(), timeout=DEFAULT_TIMEOUT):
+    """
+    Register function (bytes in, text out) as the extractor called
+    name, for the given content types and file name extensions.
+    """
+    EXTRACTORS[name] = Extractor(name, function, timeout)
+    for ctype in types:
+        TYPES[ctype.lower()] = name
+    for ext in extensions:
+        EXTENSIONS[ext.lower()] = name
+
+def extractor_for(ctype, filename):
+    """The name of the extractor for an attachment, or None."""
+    name = TYPES.get(ctype)
+    if name==None and filename:
+        name = EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+    return name
+
+def _which(program):
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(directory, program)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+class ExtractionError(RuntimeError):
+    pass
+
+class ExtractionTimeout(ExtractionError):
+    pass
+
+# Failures that needn't happen again, so aren't cached
+TRANSIENT_ERRORS = (ExtractionTimeout, EnvironmentError)
+
+def run_command(argv, data, timeout=DEFAULT_TIMEOUT):
+    """
+    Run argv, with '%s' in it replaced by the name of a file holding
+    data, and return what it writes to stdout. Kills it if it takes
+    longer than timeout seconds.
+    """
+    import subprocess
+    (infd, inname) = tempfile.mkstemp()
+    (outfd, outname) = tempfile.mkstemp()
+    try:
+        os.write(infd, data)
+        os.close(infd)
+        argv = [ arg.replace('%s', inname) for arg in argv ]
+        devnull = file(os.devnull, 'r+')
+        try:
+            proc = subprocess.Popen(argv, stdin=devnull, stdout=outfd, stderr=devnull, close_fds=True)
+        finally:
+            devnull.close()
+        deadline = time.time() + timeout
+        delay = 0.01
+        while proc.poll()==None:
+            if time.time() > deadline:
+                os.kill(proc.pid, 9)
+                proc.wait()
+                raise ExtractionTimeout("%s timed out" % argv[0])
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        if proc.returncode!=0:
+            raise ExtractionError("%s exited with %i" % (argv[0], proc.returncode))
+        os.lseek(outfd, 0, 0)
+        return os.read(outfd, MAX_TEXT_BYTES)
+    finally:
+        os.close(outfd)
+        os.unlink(outname)
+        os.unlink(inname)
+
+def command_extractor(argv):
+    def extract(data, timeout=DEFAULT_TIMEOUT):
+        return run_command(argv, data, timeout)
+    return extract
+
+_tag_re = re.compile(r'<[^>]*>')
+_para_re = re.compile(r'</(w:p|a:p|text:p|text:h|si|row)>')
+_entity_re = re.compile(r'&(#x[0-9a-fA-F]+|#[0-9]+|amp|lt|gt|quot|apos);')
+_ENTITIES = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+
+def _xml_text(xml):
+    """The text in some XML, with paragraphs on separate lines."""
+    def entity(m):
+        name = m.group(1)
+        if name.startswith('#x'):
+            return unichr(int(name[2:], 16)).encode('utf-8')
+        elif name.startswith('#'):
+            return unichr(int(name[1:])).encode('utf-8')
+        return _ENTITIES[name]
+    text = _tag_re.sub(' ', _para_re.sub('\n', xml))
+    return _entity_re.sub(entity, text)
+
+def _zip_members_text(data, wanted):
+    """Text from the XML members of a zip file that wanted() picks."""
+    import zipfile, StringIO
+    archive = zipfile.ZipFile(StringIO.StringIO(data))
+    texts = []
+    total = 0
+    names = [ n for n in archive.namelist() if wanted(n) ]
+    names.sort()
+    for name in names:
+        info = archive.getinfo(name)
+        if total + info.file_size > MAX_TEXT_BYTES * 4:
+            # mostly markup, but there has to be a limit
+            break
+        total += info.file_size
+        texts.append(_xml_text(archive.read(name)))
+    return '\n'.join(texts)
+
+def ooxml_to_text(data, timeout=None):
+    """Word, Excel and PowerPoint 2007 files."""
+    def wanted(name):
+        return (name=='word/document.xml' or name=='xl/sharedStrings.xml' or
+                (name.startswith('ppt/slides/slide') and name.endswith('.xml')))
+    return _zip_members_text(data, wanted)
+
+def odf_to_text(data, timeout=None):
+    """OpenDocument text, spreadsheets and presentations."""
+    return _zip_members_text(data, lambda name: name=='content.xml')
+
+def plain_text(data, timeout=None):
+    return data
+
+register('ooxml', ooxml_to_text,
+         ('application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+          'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+          'application/vnd.openxmlformats-officedocument.presentationml.presentation'),
+         ('.docx', '.xlsx', '.pptx'))
+register('odf', odf_to_text,
+         ('application/vnd.oasis.opendocument.text',
+          'application/vnd.oasis.opendocument.spreadsheet',
+          'application/vnd.oasis.opendocument.presentation'),
+         ('.odt', '.ods', '.odp'))
+register('text', plain_text,
+         ('text/csv', 'text/x-csv', 'text/x-diff', 'text/x-patch', 'text/x-log',
+          'text/calendar', 'text/x-vcard', 'text/xml', 'application/xml',
+          'application/json', 'application/x-sh', 'text/x-python',
+          'text/x-c', 'text/x-java'),
+         ('.txt', '.csv', '.diff', '.patch', '.log', '.ics', '.vcf', '.xml',
+          '.json', '.sh', '.py', '.c', '.h', '.java'))
+if _which('pdftotext')!=None:
+    register('pdf', command_extractor(['pdftotext', '-q', '-enc', 'UTF-8', '%s', '-']),
+             ('application/pdf', 'application/x-pdf'), ('.pdf',))
+if _which('antiword')!=None:
+    register('msword', command_extractor(['antiword', '%s']),
+             ('application/msword',), ('.doc',))
+if _which('unrtf')!=None:
+    register('rtf', command_extractor(['unrtf', '--text', '--nopict', '%s']),
+             ('application/rtf', 'text/rtf'), ('.rtf',))
+
+def register_commands(lines, timeout=DEFAULT_TIMEOUT):
+    """
+    Register extractors from lines of the 'extractors' config file:
+    content types and .extensions, then a command with %s in it.
+    """
+    for line in lines:
+        if line.startswith('#'):
+            continue
+        words = line.split()
+        types = []
+        extensions = []
+        while words and '%s' not in words[0] and ('/' in words[0] or words[0].startswith('.')):
+            if words[0].startswith('.'):
+                extensions.append(words.pop(0))
+            else:
+                types.append(words.pop(0))
+        if not words or '%s' not in ' '.join(words):
+            raise woodpecker.WoodpeckerError("Can't understand extractor '%s'." % line, "Expected content types and/or .extensions, then a command using %s.")
+        register(words[0], command_extractor(words), types, extensions, timeout)
+
+def _extract(name, data):
+    """Run an extractor (in a worker process, perhaps)."""
+    extractor = EXTRACTORS[name]
+    return extractor.function(data, extractor.timeout)[:MAX_TEXT_BYTES]
+
+class TextCache:
+    """Extracted text on disk, keyed by attachment hash and extractor."""
+    def __init__(self, path):
+        self.path = path
+
+    def _file(self, key, name):
+        return os.path.join(self.path, key[:2], '%s.%s' % (key, name))
+
+    def get(self, key, name):
+        try:
+            fp = file(self._file(key, name), 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                return zlib.decompress(fp.read())
+            except zlib.error:
+                return None
+        finally:
+            fp.close()
+
+    def put(self, key, name, text):
+        path = self._file(key, name)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # someone else got there first
+                pass
+        (fd, tmp) = tempfile.mkstemp(dir=directory)
+        try:
+            os.write(fd, zlib.compress(text))
+        finally:
+            os.close(fd)
+        os.rename(tmp, path)
+
+class AttachmentExtractor:
+    """
+    Extracts text from a message's attachments, through the cache and
+    a pool of jobs worker processes (or in-line if jobs is 0).
+    """
+    def __init__(self, config, stats, jobs=2):
+        self.cache = TextCache(config.attachmentpath)
+        self.stats = stats
+        self.jobs = jobs
+        self.pool = None
+        if jobs > 0:
+            try:
+                import multiprocessing
+                if multiprocessing.current_process().daemon:
+                    # we're a worker ourselves, so we can't have any
+                    self.jobs = 0
+            except ImportError:
+                self.jobs = 0
+
+    def _get_pool(self):
+        if self.pool==None:
+            import multiprocessing
+            self.pool = multiprocessing.Pool(self.jobs)
+        return self.pool
+
+    def _abandon_pool(self):
+        # the only way to get a stuck worker back
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+
+    def close(self):
+        if self.pool!=None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def _submit(self, name, data):
+        """Start extracting in the pool; returns (pool, async result)."""
+        if self.jobs==0:
+            return (None, None)
+        pool = self._get_pool()
+        return (pool, pool.apply_async(_extract, (name, data)))
+
+    def extract(self, attachments):
+        """
+        Text for each of attachments, a list of (extractor name,
+        decoded data); returns a list of strings, empty for any we
+        couldn't get anything from.
+        """
+        texts = [''] * len(attachments)
+        pending = []
+        for i in range(len(attachments)):
+            (name, data) = attachments[i]
+            if not data or len(data) > MAX_ATTACHMENT_BYTES:
+                continue
+            key = md5.new(data).hexdigest()
+            text = self.cache.get(key, name)
+            if text!=None:
+                self.stats.count('attachments cached')
+                texts[i] = text
+                continue
+            self.stats.count('attachments extracted')
+            pending.append((i, name, key, data, self._submit(name, data)))
+
+        for (i, name, key, data, (pool, result)) in pending:
+            t = time.time()
+            cache = True
+            try:
+                if result==None:
+                    text = _extract(name, data)
+                else:
+                    if pool is not self.pool:
+                        # lost when we gave up on an earlier one
+                        (pool, result) = self._submit(name, data)
+                    # give commands a chance to be killed cleanly first
+                    text = result.get(EXTRACTORS[name].timeout + 5)
+            except KeyboardInterrupt:
+                raise
+            except:
+                etype = sys.exc_info()[0]
+                timed_out = etype.__name__=='TimeoutError'
+                if timed_out and self.pool!=None:
+                    self._abandon_pool()
+                self.stats.fail('attachment %s: %s' % (name, etype.__name__))
+                # don't try this one again, unless it might work next time
+                cache = not (timed_out or issubclass(etype, TRANSIENT_ERRORS))
+                text = ''
+            self.stats.add('attach', time.time() - t)
+            if cache:
+                self.cache.put(key, name, text)
+            texts[i] = text
+        return texts
+
+def make_extractor(config, stats):
+    """An AttachmentExtractor as config says, or None if we're not to."""
+    if not config.extract_attachments:
+        return None
+    timeout = config.attachment_timeout
+    if timeout==None:
+        timeout = DEFAULT_TIMEOUT
+    register_commands(config.extractors, timeout)
+    if config.attachment_timeout!=None:
+        for extractor in EXTRACTORS.values():
+            extractor.timeout = config.attachment_timeout
+    return AttachmentExtractor(config, stats, config.attachment_jobs)
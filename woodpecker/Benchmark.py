@@ -0,0 +1,479 @@
+# Woodpecker benchmarks
+#
+# (c) Copyright James Aylett 2008
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+"""
+Benchmarks: make a synthetic corpus of mboxes, index it, and time a
+fixed set of queries against the result.
+
+The corpus is entirely determined by the seed and the other settings,
+so two runs with the same settings index exactly the same mail, and
+their results can be compared. Messages are a mix of text/plain,
+text/html, multipart/alternative and messages with a (large, binary)
+attachment, in several charsets; some fraction are replies, threaded
+with In-Reply-To and References. Words are drawn from a made-up
+vocabulary with a roughly Zipfian distribution, so there are both
+common and rare terms to search for.
+
+Results are written as JSON: the settings, the environment, and
+
+  index.messages_per_sec, index.mb_per_sec, index.seconds
+  index.size_bytes            size of the database on disk
+  query.p50_ms, query.p99_ms  over every run of every query
+  query.queries.<query>       the same for each query on its own
+"""
+
+import email.Encoders, email.Header, email.MIMEBase, email.MIMEMultipart
+import email.MIMEText, email.Utils
+import md5, os, platform, random, re, sys, time
+import woodpecker
+
+# Kinds of message, and how often each turns up by default
+KINDS = ('plain', 'html', 'alternative', 'attachment')
+DEFAULT_MIX = {'plain': 60, 'html': 15, 'alternative': 20, 'attachment': 5}
+
+# Charsets bodies are written in, each with some words that need it.
+# The email package picks the transfer encoding: base64 for utf-8 and
+# koi8-r, quoted-printable for iso-8859-1.
+CHARSETS = ('us-ascii', 'utf-8', 'iso-8859-1', 'koi8-r')
+EXTRA_WORDS = {
+    'utf-8': [u'caf\xe9', u'na\xefve', u'Z\xfcrich',
+              u'\u043f\u0440\u0438\u0432\u0435\u0442', u'\u65e5\u672c'],
+    'iso-8859-1': [u'caf\xe9', u'fa\xe7ade', u'M\xfcnchen', u'se\xf1or'],
+    'koi8-r': [u'\u043f\u0440\u0438\u0432\u0435\u0442',
+               u'\u043f\u043e\u0447\u0442\u0430',
+               u'\u043f\u043e\u0438\u0441\u043a'],
+}
+
+SYLLABLES = ('ka', 'lo', 'mi', 'ne', 'pu', 'ra', 'si', 'to', 've', 'zu',
+             'bar', 'dor', 'fen', 'gil', 'hap', 'jun', 'kel', 'mor', 'nix', 'pol')
+VOCABULARY_SIZE = 5000
+
+PEOPLE = 200 # how many different correspondents
+DOMAINS = ('example.com', 'example.org', 'example.net', 'lists.example.com')
+
+_from_re = re.compile(r'^(>*From )', re.M)
+
+class CorpusGenerator:
+    """
+    Writes a deterministic synthetic corpus. Nothing here depends on
+    anything but the seed and the settings, including the dates.
+    """
+    def __init__(self, seed=1, mix=None, reply_rate=0.4, charset_rate=0.2,
+                 attachment_kb=256, start_date=1104537600):
+        self.rng = random.Random(seed)
+        self.seed = seed
+        if mix==None:
+            mix = DEFAULT_MIX
+        self.mix = []
+        for kind in KINDS:
+            self.mix.extend([kind] * mix.get(kind, 0))
+        if not self.mix:
+            raise woodpecker.WoodpeckerError("No kinds of message to generate.")
+        self.reply_rate = reply_rate
+        self.charset_rate = charset_rate
+        self.attachment_kb = attachment_kb
+        self.date = start_date # 2005-01-01
+        self.count = 0
+        self.recent = [] # (message-id, references, subject) to reply to
+        self.vocabulary = self._vocabulary()
+        self.people = []
+        for i in range(PEOPLE):
+            name = '%s %s' % (self._word().capitalize(), self._word().capitalize())
+            address = '%s.%i@%s' % (name.split()[0].lower(), i, self.rng.choice(DOMAINS))
+            self.people.append((name, address))
+
+    def _vocabulary(self):
+        words = {}
+        vocabulary = []
+        while len(vocabulary) < VOCABULARY_SIZE:
+            word = ''.join([ self.rng.choice(SYLLABLES) for i in range(self.rng.randint(1, 4)) ])
+            if not words.has_key(word):
+                words[word] = True
+                vocabulary.append(word)
+        return vocabulary
+
+    def _word(self):
+        # index ~ 1/x: a few words very common, most rare
+        i = int(len(self.vocabulary) ** self.rng.random()) - 1
+        return self.vocabulary[i]
+
+    def _sentence(self, extra=None):
+        words = [ self._word() for i in range(self.rng.randint(4, 14)) ]
+        if extra!=None and self.rng.random() < 0.3:
+            words.insert(self.rng.randrange(len(words)), self.rng.choice(extra))
+        return u' '.join(words).capitalize() + u'.'
+
+    def _paragraphs(self, extra):
+        paras = []
+        for i in range(self.rng.randint(1, 6)):
+            paras.append(u' '.join([ self._sentence(extra) for j in range(self.rng.randint(1, 5)) ]))
+        return paras
+
+    def _blob(self, nbytes):
+        # random-looking bytes, cheaply and reproducibly
+        out = []
+        block = '%i:%i' % (self.seed, self.count)
+        while nbytes > 0:
+            block = md5.new(block).digest()
+            out.append(block)
+            nbytes -= len(block)
+        return ''.join(out)
+
+    def _text_part(self, paras, charset, subtype='plain'):
+        if subtype=='html':
+            body = u'<html><head><style>p { margin: 0 }</style></head><body>\n%s\n</body></html>\n' % u'\n'.join([ u'<p>%s</p>' % p.replace(u'.', u'. <b>', 1) + u'</b>' for p in paras ])
+        else:
+            body = u'\n\n'.join(paras) + u'\n'
+        return email.MIMEText.MIMEText(body.encode(charset), subtype, charset)
+
+    def message(self):
+        """The next message, as (text without a From_ line, sender)."""
+        self.count += 1
+        self.date += self.rng.randint(60, 6 * 3600)
+        kind = self.rng.choice(self.mix)
+        if self.rng.random() < self.charset_rate:
+            charset = self.rng.choice(CHARSETS[1:])
+            extra = EXTRA_WORDS[charset]
+        else:
+            charset = 'us-ascii'
+            extra = None
+        paras = self._paragraphs(extra)
+
+        if kind=='plain':
+            mess = self._text_part(paras, charset)
+        elif kind=='html':
+            mess = self._text_part(paras, charset, 'html')
+        else:
+            # the email package would pick a random boundary
+            boundary = '=_%i_%i' % (self.seed, self.count)
+            mess = email.MIMEMultipart.MIMEMultipart(kind=='alternative' and 'alternative' or 'mixed', boundary)
+            mess.attach(self._text_part(paras, charset))
+            if kind=='alternative':
+                mess.attach(self._text_part(paras, charset, 'html'))
+            else:
+                attachment = email.MIMEBase.MIMEBase('application', 'octet-stream')
+                attachment.set_payload(self._blob(self.rng.randint(self.attachment_kb / 2, self.attachment_kb) * 1024))
+                email.Encoders.encode_base64(attachment)
+                attachment.add_header('Content-Disposition', 'attachment', filename='%s.bin' % self._word())
+                mess.attach(attachment)
+
+        (sender, recipient) = self.rng.sample(self.people, 2)
+        mid = '%i.%i@synthetic.example.com' % (self.seed, self.count)
+        if self.recent and self.rng.random() < self.reply_rate:
+            (parent, refs, subject) = self.rng.choice(self.recent)
+            refs = refs + [parent]
+            if not subject.startswith('Re: '):
+                subject = 'Re: ' + subject
+            mess['In-Reply-To'] = '<%s>' % parent
+            mess['References'] = ' '.join([ '<%s>' % r for r in refs[-10:] ])
+        else:
+            refs = []
+            subject = ' '.join([ self._word() for i in range(self.rng.randint(2, 7)) ]).capitalize()
+            if extra!=None:
+                subject = subject + ' ' + self.rng.choice(extra).encode('utf-8')
+        self.recent.append((mid, refs, subject))
+        if len(self.recent) > 50:
+            del self.recent[0]
+
+        mess['From'] = email.Utils.formataddr(sender)
+        mess['To'] = email.Utils.formataddr(recipient)
+        if extra!=None:
+            mess['Subject'] = email.Header.Header(unicode(subject, 'utf-8'), charset).encode()
+        else:
+            mess['Subject'] = subject
+        mess['Date'] = email.Utils.formatdate(self.date)
+        mess['Message-ID'] = '<%s>' % mid
+        return (mess.as_string(), sender[1])
+
+    def write_mbox(self, fp, count):
+        """Append count messages to an open mbox; returns bytes written."""
+        written = 0
+        for i in range(count):
+            (text, sender) = self.message()
+            entry = 'From %s %s\n%s\n\n' % (sender, time.asctime(time.gmtime(self.date)), _from_re.sub(r'>\1', text))
+            fp.write(entry)
+            written += len(entry)
+        return written
+
+def generate(directory, messages=1000, mboxes=4, **kwargs):
+    """
+    Write a corpus of messages spread over mboxes mboxes in directory.
+    Other arguments go to CorpusGenerator. Returns (list of mboxes,
+    total bytes).
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    generator = CorpusGenerator(**kwargs)
+    paths = []
+    total = 0
+    for i in range(mboxes):
+        path = os.path.join(directory, 'mbox%02i' % i)
+        count = messages / mboxes
+        if i < messages % mboxes:
+            count += 1
+        fp = file(path, 'wb')
+        try:
+            total += generator.write_mbox(fp, count)
+        finally:
+            fp.close()
+        paths.append(path)
+    return (paths, total)
+
+def query_set(vocabulary):
+    """
+    The queries we time: picked from the vocabulary by rank, so the
+    same settings always give the same queries.
+    """
+    common = vocabulary[0:5]
+    middling = vocabulary[50:55]
+    rare = vocabulary[2000:2005]
+    return [
+        ('common', common[0]),
+        ('middling', middling[0]),
+        ('rare', rare[0]),
+        ('and', '%s %s' % (common[1], middling[1])),
+        ('or', '%s OR %s OR %s' % (common[2], middling[2], rare[2])),
+        ('phrase', '"%s %s"' % (common[3], common[4])),
+        ('subject', 'subject:%s' % middling[3]),
+        ('date', '%s date:2005..2006' % common[0]),
+        ('not', '%s -%s' % (common[1], common[2])),
+    ]
+
+def _percentile(values, p):
+    values = values[:]
+    values.sort()
+    i = int(round(p / 100.0 * (len(values) - 1)))
+    return values[i]
+
+def _disk_usage(path):
+    total = 0
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for name in filenames:
+            total += os.path.getsize(os.path.join(dirpath, name))
+    return total
+
+def run(workdir, messages=1000, mboxes=4, seed=1, jobs=1, repeat=20,
+        mix=None, reply_rate=0.4, charset_rate=0.2, attachment_kb=256,
+        verbose=False):
+    """
+    Generate a corpus in workdir, index it from scratch and time
+    queries against it. Returns a dict of results.
+    """
+    import woodpecker.Indexer, woodpecker.Search
+    import xapian
+    settings = {'messages': messages, 'mboxes': mboxes, 'seed': seed,
+                'jobs': jobs, 'repeat': repeat, 'mix': mix or DEFAULT_MIX,
+                'reply_rate': reply_rate, 'charset_rate': charset_rate,
+                'attachment_kb': attachment_kb}
+    results = {'settings': settings}
+    results['environment'] = {
+        'python': sys.version.split()[0],
+        'xapian': xapian.version_string(),
+        'woodpecker': woodpecker.VERSION,
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+    start = time.time()
+    (paths, nbytes) = generate(os.path.join(workdir, 'mail'), messages, mboxes,
+                               seed=seed, mix=mix, reply_rate=reply_rate,
+                               charset_rate=charset_rate, attachment_kb=attachment_kb)
+    results['corpus'] = {'bytes': nbytes, 'seconds': time.time() - start}
+
+    confdir = os.path.join(workdir, 'conf')
+    if os.path.exists(confdir):
+        import shutil
+        shutil.rmtree(confdir)
+    os.makedirs(confdir)
+    conf = woodpecker.Config(confdir)
+    start = time.time()
+    if jobs > 1:
+        pecker = woodpecker.Indexer.ParallelPecker(conf, verbose, True, None, jobs)
+    else:
+        pecker = woodpecker.Indexer.Pecker(conf, verbose, True)
+    pecker.index_mailbox(paths)
+    pecker.close()
+    stats = pecker.stats.as_dict()
+    del pecker
+    elapsed = time.time() - start
+    results['index'] = {
+        'stats': stats,
+        'seconds': elapsed,
+        'messages_per_sec': messages / elapsed,
+        'mb_per_sec': nbytes / 1048576.0 / elapsed,
+        'size_bytes': _disk_usage(conf.dbpath),
+    }
+
+    searcher = woodpecker.Search.Searcher(conf)
+    vocabulary = CorpusGenerator(seed=seed).vocabulary
+    timings = {}
+    everything = []
+    for (name, query_string) in query_set(vocabulary):
+        times = []
+        for i in range(repeat):
+            t = time.time()
+            searcher.set_query(searcher.parse(query_string))
+            for m in searcher.get_mset(0, 10):
+                searcher.row(m)
+            times.append((time.time() - t) * 1000)
+        timings[name] = {'query': query_string,
+                         'p50_ms': _percentile(times, 50),
+                         'p99_ms': _percentile(times, 99)}
+        everything.extend(times)
+    results['query'] = {'p50_ms': _percentile(everything, 50),
+                        'p99_ms': _percentile(everything, 99),
+                        'queries': timings}
+    return results
+
+def compare(old, new):
+    """Lines describing how the headline numbers changed between runs."""
+    lines = []
+    for (section, key, better) in (('index', 'messages_per_sec', 1),
+                                   ('index', 'mb_per_sec', 1),
+                                   ('index', 'size_bytes', -1),
+                                   ('query', 'p50_ms', -1),
+                                   ('query', 'p99_ms', -1)):
+        a = old.get(section, {}).get(key)
+        b = new.get(section, {}).get(key)
+        if not a or b==None:
+            continue
+        change = (b - a) * 100.0 / a
+        if change * better < 0:
+            verdict = 'worse'
+        else:
+            verdict = 'better'
+        lines.append('%s.%s: %.2f -> %.2f (%+.1f%%, %s)' % (section, key, a, b, change, verdict))
+    return lines
+
+def _parse_mix(arg):
+    mix = {}
+    for item in arg.split(','):
+        (kind, weight) = item.split('=', 1)
+        if kind not in KINDS:
+            raise ValueError("Unknown kind of message '%s'." % kind)
+        mix[kind] = int(weight)
+    return mix
+
+def usage():
+    print u"Usage: %s [options]" % sys.argv[0]
+    print u"Options:"
+    print u"\t--help\t\tThis message"
+    print u"\t--workdir d\tBuild the corpus and index in d (default: a temporary"
+    print u"\t\t\tdirectory, removed afterwards)"
+    print u"\t--messages n\tGenerate n messages (default 1000)"
+    print u"\t--mboxes n\tSpread them over n mboxes (default 4)"
+    print u"\t--seed n\tSeed for the generator (default 1)"
+    print u"\t--mix m\t\tRelative weights of each kind of message"
+    print u"\t\t\t(default %s)" % ','.join([ '%s=%i' % (k, DEFAULT_MIX[k]) for k in KINDS ])
+    print u"\t--replies f\tFraction of messages that are replies (default 0.4)"
+    print u"\t--charsets f\tFraction not in us-ascii (default 0.2)"
+    print u"\t--attachment-kb n\tLargest attachment, in KB (default 256)"
+    print u"\t--jobs n\tIndex with n worker processes"
+    print u"\t--repeat n\tRun each query n times (default 20)"
+    print u"\t--output f\tWrite results to f rather than stdout"
+    print u"\t--compare f\tAlso show how these results differ from those in f"
+
+def main():
+    try:
+        import json
+    except ImportError:
+        import simplejson as json
+    import getopt, shutil, tempfile
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'hd:n:j:o:',
+                                      ['help', 'workdir=', 'messages=', 'mboxes=',
+                                       'seed=', 'mix=', 'replies=', 'charsets=',
+                                       'attachment-kb=', 'jobs=', 'repeat=',
+                                       'output=', 'compare=', 'verbose'])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    workdir = None
+    output = None
+    previous = None
+    kwargs = {}
+    try:
+        for opt, arg in optlist:
+            if opt in ('-h', '--help'):
+                usage()
+                sys.exit()
+            if opt in ('-d', '--workdir'):
+                workdir = arg
+            if opt in ('-n', '--messages'):
+                kwargs['messages'] = int(arg)
+            if opt=='--mboxes':
+                kwargs['mboxes'] = int(arg)
+            if opt=='--seed':
+                kwargs['seed'] = int(arg)
+            if opt=='--mix':
+                kwargs['mix'] = _parse_mix(arg)
+            if opt=='--replies':
+                kwargs['reply_rate'] = float(arg)
+            if opt=='--charsets':
+                kwargs['charset_rate'] = float(arg)
+            if opt=='--attachment-kb':
+                kwargs['attachment_kb'] = int(arg)
+            if opt in ('-j', '--jobs'):
+                kwargs['jobs'] = int(arg)
+            if opt=='--repeat':
+                kwargs['repeat'] = int(arg)
+            if opt in ('-o', '--output'):
+                output = arg
+            if opt=='--compare':
+                previous = arg
+            if opt=='--verbose':
+                kwargs['verbose'] = True
+    except ValueError:
+        usage()
+        sys.exit(2)
+
+    if workdir==None:
+        tmpdir = tempfile.mkdtemp(prefix='woodpecker-bench')
+    else:
+        tmpdir = None
+    try:
+        try:
+            results = run(tmpdir or workdir, **kwargs)
+        except woodpecker.WoodpeckerError, e:
+            sys.stdout.write(str(e))
+            sys.stdout.write("\n")
+            print e.aux
+            sys.exit(1)
+    finally:
+        if tmpdir!=None:
+            shutil.rmtree(tmpdir)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if output!=None:
+        fp = file(output, 'w')
+        try:
+            fp.write(text + '\n')
+        finally:
+            fp.close()
+    else:
+        print text
+    if previous!=None:
+        fp = file(previous)
+        try:
+            old = json.load(fp)
+        finally:
+            fp.close()
+        for line in compare(old, results):
+            sys.stderr.write(line + '\n')
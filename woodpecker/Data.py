@@ -0,0 +1,231 @@
+# Woodpecker document data
+#
+# (c) Copyright James Aylett 2008
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+"""
+Serialisation of the fields we keep in each document's data (From,
+Title, Sample, Filename and so on).
+
+The first byte says what format the rest is in:
+
+ * '\\x01' -- compact binary, version 1. A sequence of records, each
+   a varint tag, (fieldnum << 1) | kind, followed by the value: for
+   kind 0 a varint length and that many bytes, for kind 1 a zigzag
+   varint integer. Fields not in FIELDS get fieldnum 0, and their
+   name (varint length then bytes) goes before the value.
+
+ * 'J' -- JSON, for people who want to read their index by eye.
+
+ * '{' -- what we used to store, repr() of a dict. We can still read
+   it (without eval), and Indexer.Pecker.migrate_data() rewrites it.
+
+decode() can be asked for just some fields, in which case it skips
+over the others without unpacking them.
+"""
+
+BINARY = 'binary'
+JSON = 'json'
+FORMATS = (BINARY, JSON)
+
+BINARY_V1 = '\x01'
+JSON_V1 = 'J'
+LEGACY = '{'
+
+# Field numbers are forever: only ever add to the end of this.
+FIELDS = ('From', 'To', 'Cc', 'Title', 'Date', 'Sample', 'Filename',
+          'MessageNum', 'FromName', 'ToName', 'Mine', 'Flags', 'Truncated')
+FIELD_NUMS = {}
+for i in range(len(FIELDS)):
+    FIELD_NUMS[FIELDS[i]] = i + 1
+
+KIND_STRING = 0
+KIND_INT = 1
+
+class DataError(ValueError):
+    pass
+
+def _write_varint(n, out):
+    while n >= 0x80:
+        out.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.append(chr(n))
+
+def _read_varint(s, pos):
+    n = 0
+    shift = 0
+    while True:
+        try:
+            b = ord(s[pos])
+        except IndexError:
+            raise DataError("Truncated document data.")
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return (n, pos)
+        shift += 7
+
+def _write_string(s, out):
+    if type(s) is unicode:
+        s = s.encode('utf-8')
+    _write_varint(len(s), out)
+    out.append(s)
+
+def _encode_binary(data):
+    out = [BINARY_V1]
+    for (name, value) in data.items():
+        if type(value) in (int, long):
+            kind = KIND_INT
+        else:
+            kind = KIND_STRING
+        num = FIELD_NUMS.get(name, 0)
+        _write_varint((num << 1) | kind, out)
+        if num==0:
+            _write_string(name, out)
+        if kind==KIND_INT:
+            # zigzag, so small negative numbers stay small
+            if value < 0:
+                _write_varint((-value << 1) - 1, out)
+            else:
+                _write_varint(value << 1, out)
+        else:
+            _write_string(value, out)
+    return ''.join(out)
+
+def _decode_binary(s, fields):
+    data = {}
+    if fields!=None:
+        wanted = len(fields)
+    pos = 1
+    end = len(s)
+    while pos < end:
+        (tag, pos) = _read_varint(s, pos)
+        num = tag >> 1
+        kind = tag & 1
+        if num==0:
+            (length, pos) = _read_varint(s, pos)
+            name = s[pos:pos + length]
+            pos += length
+        elif num <= len(FIELDS):
+            name = FIELDS[num - 1]
+        else:
+            # from a newer woodpecker; keep it under a made-up name
+            name = '_%i' % num
+        if kind==KIND_INT:
+            (value, pos) = _read_varint(s, pos)
+            if fields==None or name in fields:
+                if value & 1:
+                    data[name] = -((value + 1) >> 1)
+                else:
+                    data[name] = value >> 1
+        else:
+            (length, pos) = _read_varint(s, pos)
+            if fields==None or name in fields:
+                data[name] = s[pos:pos + length]
+            pos += length
+        if fields!=None and name in fields:
+            wanted -= 1
+            if wanted==0:
+                break
+    if pos > end:
+        raise DataError("Truncated document data.")
+    return data
+
+def _json():
+    try:
+        import json
+    except ImportError:
+        import simplejson as json
+    return json
+
+def _encode_json(data):
+    # headers aren't necessarily UTF-8, so treat bytes as latin-1, which
+    # round-trips anything
+    return JSON_V1 + _json().dumps(data, encoding='latin-1', separators=(',', ':'))
+
+def _decode_json(s, fields):
+    data = {}
+    for (name, value) in _json().loads(s[1:]).items():
+        name = name.encode('latin-1')
+        if fields!=None and name not in fields:
+            continue
+        if type(value) is unicode:
+            value = value.encode('latin-1')
+        data[name] = value
+    return data
+
+def _decode_legacy(s, fields):
+    try:
+        from ast import literal_eval
+    except ImportError:
+        from compiler import parse
+        from compiler.ast import Const, Dict, Expression
+        def literal_eval(s):
+            # just enough for a dict of strings and ints
+            node = parse(s, 'eval')
+            if not isinstance(node, Expression) or not isinstance(node.node, Dict):
+                raise DataError("Unrecognised document data.")
+            d = {}
+            for (k, v) in node.node.items:
+                if not isinstance(k, Const) or not isinstance(v, Const):
+                    raise DataError("Unrecognised document data.")
+                d[k.value] = v.value
+            return d
+    try:
+        data = literal_eval(s)
+    except (SyntaxError, ValueError):
+        raise DataError("Unrecognised document data.")
+    if type(data) is not dict:
+        raise DataError("Unrecognised document data.")
+    if fields!=None:
+        for name in data.keys():
+            if name not in fields:
+                del data[name]
+    return data
+
+def encode(data, format=BINARY):
+    """Serialise a dict of document data (string and int values)."""
+    if format==BINARY:
+        return _encode_binary(data)
+    elif format==JSON:
+        return _encode_json(data)
+    raise DataError("Unknown document data format '%s'." % format)
+
+def decode(s, fields=None):
+    """
+    Unpack document data, in any format we've ever written it in. If
+    fields is given, only those fields are decoded (and returned, if
+    they're present).
+    """
+    if s=='':
+        return {}
+    marker = s[0]
+    if marker==BINARY_V1:
+        return _decode_binary(s, fields)
+    elif marker==JSON_V1:
+        return _decode_json(s, fields)
+    elif marker==LEGACY:
+        return _decode_legacy(s, fields)
+    raise DataError("Unrecognised document data format.")
+
+def is_current(s, format=BINARY):
+    """Is s already in the format we'd write now?"""
+    if s=='':
+        return True
+    if format==BINARY:
+        return s[0]==BINARY_V1
+    return s[0]==JSON_V1
@@ -0,0 +1,124 @@
+# Woodpecker HTML to text conversion
+#
+# (c) Copyright James Aylett 2008
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+"""
+Turn text/html parts into plain text for indexing, in-process. We only
+care about the words, so layout is reduced to line breaks between
+block elements, and script and style contents are dropped entirely.
+"""
+
+import HTMLParser, htmlentitydefs, re
+
+from woodpecker.Utils import make_temp_file, remove_temp_file, stdout_to_string
+
+class TextExtractor(HTMLParser.HTMLParser):
+    """
+    Streaming HTML to text converter: feed() it HTML as it arrives,
+    then close() and get_text().
+    """
+    IGNORED = ('script', 'style')
+    BLOCKS = ('address', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt',
+              'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'li', 'ol', 'p',
+              'pre', 'table', 'td', 'th', 'title', 'tr', 'ul')
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.pieces = []
+        self.ignoring = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.IGNORED:
+            self.ignoring += 1
+        elif tag in self.BLOCKS:
+            self.pieces.append('\n')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in self.BLOCKS:
+            self.pieces.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.IGNORED:
+            if self.ignoring > 0:
+                self.ignoring -= 1
+        elif tag in self.BLOCKS:
+            self.pieces.append('\n')
+
+    def handle_data(self, data):
+        if not self.ignoring:
+            self.pieces.append(data)
+
+    def unescape(self, s):
+        # only used on attribute values, which we don't look at; the
+        # real thing fails on non-ASCII bytes alongside an entity
+        return s
+
+    def handle_charref(self, name):
+        try:
+            if name[0] in 'xX':
+                c = int(name[1:], 16)
+            else:
+                c = int(name)
+            self.handle_data(unichr(c).encode('utf-8'))
+        except (ValueError, OverflowError):
+            pass
+
+    def handle_entityref(self, name):
+        c = htmlentitydefs.name2codepoint.get(name)
+        if c!=None:
+            self.handle_data(unichr(c).encode('utf-8'))
+        else:
+            self.handle_data('&%s' % name)
+
+    def get_text(self):
+        return ''.join(self.pieces)
+
+_ignored_re = re.compile(r'<(script|style)\b.*?</\1\s*>', re.I | re.S)
+_tag_re = re.compile(r'<[^>]*>')
+
+def strip_tags(html):
+    """Crude fallback for HTML too broken for HTMLParser."""
+    return _tag_re.sub(' ', _ignored_re.sub(' ', html))
+
+def html_to_text(html):
+    """Convert a string of HTML to text, in-process."""
+    parser = TextExtractor()
+    try:
+        parser.feed(html)
+        parser.close()
+    except (HTMLParser.HTMLParseError, UnicodeError):
+        return strip_tags(html)
+    return parser.get_text()
+
+def elinks_html_to_text(html):
+    """Convert a string of HTML to text using elinks --dump."""
+    tfl = make_temp_file(html)
+    try:
+        return stdout_to_string("elinks --dump %s" % tfl)
+    finally:
+        remove_temp_file(tfl)
+
+CONVERTERS = { 'builtin': html_to_text,
+               'elinks': elinks_html_to_text }
+
+def get_converter(name):
+    try:
+        return CONVERTERS[name]
+    except KeyError:
+        import woodpecker
+        raise woodpecker.WoodpeckerError("Unknown HTML converter '%s'." % name, "Choose from: %s" % ', '.join(CONVERTERS.keys()))
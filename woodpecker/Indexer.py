@@ -17,56 +17,195 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301
 # USA
 
-import email.Utils, mailbox, getopt
-import random, md5, sys, socket, string, time
+import email, email.Errors, email.Utils, getopt, mmap, os
+import md5, re, sys, string, time
 import xapian
-import woodpecker.Utils
+import woodpecker, woodpecker.Attachments, woodpecker.Data, woodpecker.HTML
+import woodpecker.Maildir, woodpecker.Maintenance, woodpecker.MBox, woodpecker.Shards
+import woodpecker.Stats, woodpecker.Threads, woodpecker.Utils, woodpecker.Watch
 
-from woodpecker.Utils import make_temp_file, remove_temp_file, stdout_to_string
+# However big a message is, we index no more text than this from any
+# one part of it, or from all of it
+MAX_PART_TEXT = 1024 * 1024
+MAX_MESSAGE_TEXT = 4 * 1024 * 1024
+# Messages bigger than this have their bodies cut down as they're
+# parsed, to what could give that much text (quoted-printable can
+# take up to three times the space, but rarely does)...
+BIG_MESSAGE = 2 * MAX_PART_TEXT
+# ...and lose any attachments too big to extract text from
+MAX_RAW_ATTACHMENT = woodpecker.Attachments.MAX_ATTACHMENT_BYTES * 14 / 10 # base64
 
-hostname = socket.getfqdn()
+MAX_SAMPLE_LENGTH = 300
 
-class Pecker:
+# Bump this when make_document() changes what it puts in documents, so
+# that unchanged messages get rebuilt anyway
+DOCUMENT_VERSION = 1
+
+# what str.isalnum() says yes to, in the C locale, and everything else
+_ALNUM = string.ascii_letters + string.digits
+_NOT_ALNUM = ''.join([ chr(c) for c in range(256) if chr(c) not in _ALNUM ])
+
+def make_sample(texts, length=MAX_SAMPLE_LENGTH):
+    """
+    The sample of a message's text we store, to show with results: the
+    start of each of texts, cut at the end of a word, with '...'
+    between them, until we have about length characters.
+    """
+    sample = ''
+    for text in texts:
+        if text=='' or len(sample) >= length:
+            continue
+        if sample!='':
+            sample += '...'
+        room = length - len(sample)
+        if room <= 0:
+            break
+        if len(text) <= room:
+            end = text
+        else:
+            # back up out of the word we've cut into
+            end = text[:room + 1].rstrip(_ALNUM)
+        if len(end) <= 1:
+            # one long word; have some of it
+            sample += text[:room / 2] + '...'
+        else:
+            # and then to the end of the word before
+            sample += end.rstrip(_NOT_ALNUM) or end[0]
+    return sample
+
+def _is_under(path, prefixes):
+    """Is path (absolute) one of prefixes, or inside one of them?"""
+    for prefix in prefixes:
+        if path==prefix or path.startswith(prefix + os.sep):
+            return True
+    return False
+
+class DocumentBuilder:
+    """
+    Turns email messages into Xapian documents. Doesn't touch the
+    database, so it's safe to have one of these in each worker process
+    when indexing in parallel.
+    """
     def __init__(self, config, verbose=True):
-        self.database = config.get_writeable_index()
         self.indexer = xapian.TermGenerator()
         if config.language!=None:
             self.stemmer = xapian.Stem(config.language)
             self.indexer.set_stemmer(self.stemmer)
-        self.VALUE_UTCDATETIME = 0 # as serialised float
-        self.VALUE_UTCDATE = 1 # as YYMMDD
+        self.VALUE_UTCDATETIME = woodpecker.VALUE_UTCDATETIME
+        self.VALUE_UTCDATE = woodpecker.VALUE_UTCDATE
+        self.VALUE_FINGERPRINT = woodpecker.VALUE_FINGERPRINT
+        self.VALUE_BUILD = woodpecker.VALUE_BUILD
+        self.html_to_text = woodpecker.HTML.get_converter(config.html_converter)
+        self.data_format = config.data_format
+        self.my_addresses = {}
+        for adr in config.my_addresses:
+            self.my_addresses[adr.lower()] = True
         self.logger = woodpecker.Utils.Logger(verbose)
+        self.stats = woodpecker.Stats.Stats()
+        self.attachments = woodpecker.Attachments.make_extractor(config, self.stats)
+        # everything that changes the document we'd build from the same
+        # message, stored alongside its fingerprint
+        build = [ str(DOCUMENT_VERSION), str(config.language), config.html_converter,
+                  ','.join(sorted(self.my_addresses.keys())) ]
+        if self.attachments!=None:
+            build.append(','.join(config.extractors))
+        self.build_key = md5.new('\n'.join(build)).hexdigest()
 
-    def flush(self):
-        self.database.flush()
+    def close(self):
+        if self.attachments!=None:
+            self.attachments.close()
 
-    def index_part(self, part):
-        if part.is_multipart():
-            for subpart in part.get_payload():
-                self.index_part(subpart)
-        else:
-            if part.get_content_type=='text/plain':
-                self.indexer.index_text(part.get_payload(decode=True))
-            if part.get_content_type=='text/html':
-                txt = part.get_payload(decode=True)
-                tfl = make_temp_file(txt)
-                txt = stdout_to_string("elinks --dump %s" % tfl)
-                remove_temp_file(tfl)
-                self.indexer.index_text(txt)
-            # TODO: anything useful for other types?
+    def _keep_part(self, part):
+        return self.attachments!=None and woodpecker.Attachments.extractor_for(part.get_content_type(), part.get_filename())!=None
 
-            self.indexer.increase_termpos()
+    def cut_message(self, buf):
+        """
+        Cut the bodies of a big raw message (string or buffer) down to
+        what we'll index, without ever holding all of it; see
+        Utils.BodyFilter. Returns (raw message, number of parts cut).
+        """
+        if len(buf) <= BIG_MESSAGE:
+            return (str(buf), 0)
+        t = time.time()
+        body_filter = woodpecker.Utils.BodyFilter(BIG_MESSAGE, MAX_RAW_ATTACHMENT, self._keep_part)
+        raw = ''.join(body_filter.lines(buf))
+        self.stats.add('parse', time.time() - t)
+        return (raw, body_filter.truncated)
 
-    def _qterm(self, mess):
-        # generate a Q-term
-        mid = mess.get("message-id")
-        if mid==None:
-            # generate our own message id
-            local_part = random.randint(0,4*1024*1024*1024*1023)
-            mid = "%i@woodpecker.%s" % (local_part, hostname)
+    def parse_message(self, buf):
+        """
+        Parse a raw message (string or buffer), cutting big ones down as
+        we go. Returns an email.Message, with truncated_parts set to the
+        number of parts cut, or '' if it can't be parsed.
+        """
+        t = time.time()
+        if len(buf) <= BIG_MESSAGE:
+            mess = woodpecker.Utils.msgfactory_buffer(buf)
+            truncated = 0
         else:
+            body_filter = woodpecker.Utils.BodyFilter(BIG_MESSAGE, MAX_RAW_ATTACHMENT, self._keep_part)
+            mess = woodpecker.Utils.msgfactory_filtered(buf, body_filter)
+            truncated = body_filter.truncated
+        self.stats.add('parse', time.time() - t)
+        if mess!="":
+            mess.truncated_parts = truncated
+        return mess
+
+    def _limit_text(self, txt):
+        """Cut txt down to what we have room to index, counting any cut."""
+        limit = min(MAX_PART_TEXT, self.text_left)
+        if len(txt) > limit:
+            txt = txt[:limit]
+            self.truncated += 1
+        self.text_left -= len(txt)
+        return txt
+
+    def decode_parts(self, mess):
+        """
+        Go through the parts of mess, decoding each one we have a use
+        for, once. Returns (texts, attachments): texts is a list of
+        (content type, text) for the text/plain and text/html parts,
+        with HTML made into text and everything cut down as
+        _limit_text() says; attachments is a list of (extractor name,
+        data) for those we might get text out of.
+        """
+        texts = []
+        attachments = []
+        for part in mess.walk():
+            if part.is_multipart():
+                continue
+            ctype = part.get_content_type()
+            if ctype in ('text/plain', 'text/html'):
+                t = time.time()
+                txt = part.get_payload(decode=True) or ''
+                self.stats.add('decode', time.time() - t)
+                if ctype=='text/html':
+                    t = time.time()
+                    txt = self.html_to_text(txt)
+                    self.stats.add('html', time.time() - t)
+                texts.append((ctype, self._limit_text(txt)))
+            elif self.attachments!=None:
+                name = woodpecker.Attachments.extractor_for(ctype, part.get_filename())
+                if name!=None:
+                    t = time.time()
+                    data = part.get_payload(decode=True)
+                    self.stats.add('decode', time.time() - t)
+                    if data:
+                        attachments.append((name, data))
+        return (texts, attachments)
+
+    def qterm_for(self, headers, buf):
+        """
+        The Q-term for the raw message in buf (string or buffer), whose
+        headers are as from Utils.message_headers(buf).
+        """
+        mid = headers.get("message-id")
+        if mid!=None:
             mid = mid.strip()
             mid = mid.strip("<>")
+        if mid==None or mid.strip()=='':
+            # make up our own, the same every time
+            mid = woodpecker.Utils.synthetic_message_id(headers, buf)
 
         qterm = "Q:%s" % mid
         MAX_URL_LENGTH = 240
@@ -76,29 +215,56 @@ class Pecker:
             qterm = qterm[0:MAX_URL_LENGTH - HASH_LEN] + hash
         return qterm
 
-    def index_message(self, mess, source):
-        qterm = self._qterm(mess)
+    def make_document(self, mess, source, qterm, fingerprint=None):
+        """
+        Build the document for mess, whose Q-term is qterm (from
+        qterm_for()); returns (qterm, document).
+        """
         doc = xapian.Document()
         self.indexer.set_document(doc)
 
         doc.add_term(qterm)
         source.add_terms(self.indexer)
+        for term in source.get_terms():
+            doc.add_term(term, 0)
+        for (slot, value) in source.get_values().items():
+            doc.add_value(slot, value)
+        if fingerprint!=None:
+            doc.add_value(self.VALUE_FINGERPRINT, fingerprint)
+        doc.add_value(self.VALUE_BUILD, self.build_key)
 
         # index headers
+        t = time.time()
         self.indexer.index_text_without_positions(mess.get("from", ""), 1, 'A')
         self.indexer.index_text_without_positions(mess.get("to", ""), 1, 'XT')
         self.indexer.index_text_without_positions(mess.get("cc", ""), 1, 'XT')
         self.indexer.index_text_without_positions(mess.get("subject", ""), 1, 'S')
+        self.stats.add('termgen', time.time() - t)
 
         # G (newsgroup, mailing list or similar)
         # K (keyword?)
         # L (ISO language code)
         # T (mime type -- if we index parts separately, say attachments)
 
-        # index text
-        self.index_part(mess)
+        # index text, up to MAX_MESSAGE_TEXT of it
+        self.text_left = MAX_MESSAGE_TEXT
+        self.truncated = getattr(mess, 'truncated_parts', 0)
+        (texts, attachments) = self.decode_parts(mess)
+        t = time.time()
+        for (ctype, text) in texts:
+            self.indexer.index_text(text)
+            self.indexer.increase_termpos()
         self.indexer.increase_termpos()
+        self.stats.add('termgen', time.time() - t)
+        if attachments:
+            for text in self.attachments.extract(attachments):
+                text = self._limit_text(text)
+                t = time.time()
+                self.indexer.index_text(text)
+                self.indexer.increase_termpos()
+                self.stats.add('termgen', time.time() - t)
 
+        t = time.time()
         self.indexer.index_text(mess.get("from", ""))
         self.indexer.increase_termpos()
         self.indexer.index_text(mess.get("to", ""))
@@ -109,6 +275,7 @@ class Pecker:
         self.indexer.increase_termpos()
         self.indexer.index_text(mess.get("date", ""))
         self.indexer.increase_termpos()
+        self.stats.add('termgen', time.time() - t)
 
         try:
             date = mess["date"]
@@ -127,31 +294,9 @@ class Pecker:
         except:
             pass
 
-        sample = ""
-
-        MAX_SAMPLE_LENGTH = 300
-        for part in mess.walk():
-            if part.get_content_type()=="text/plain":
-                text = part.get_payload(decode=True)
-                if text==None:
-                    #print "Ignoring a part in %s [%s]" % (qterm, str(mess.is_multipart()))
-                    continue
-                if len(sample)<MAX_SAMPLE_LENGTH and len(sample)>0:
-                    sample+="..."
-                j = MAX_SAMPLE_LENGTH - len(sample)
-                if j >= len(text):
-                    j = len(text)-1
-                while j>0 and text[j].isalnum():
-                    j-=1
-                if j==0:
-                    length = (MAX_SAMPLE_LENGTH-len(sample))/2
-                    if length>len(text):
-                        length = len(text)
-                    sample += text[0:length] + "..."
-                else:
-                    while j>0 and not text[j].isalnum():
-                        j-=1
-                    sample += text[0:j+1]
+        t = time.time()
+        sample = make_sample([ text for (ctype, text) in texts if ctype=='text/plain' ])
+        self.stats.add('sample', time.time() - t)
 
         data = { 'From': mess.get("from", ""),
                  'To': mess.get("to", ""),
@@ -160,78 +305,1094 @@ class Pecker:
                  'Sample': sample }
         if mess.get("cc")!=None:
             data['Cc'] = mess.get("cc")
-                    
+        if self.truncated:
+            # some of the text wasn't indexed
+            data['Truncated'] = self.truncated
+            self.stats.count('truncated')
+
+        # things the result list shows, so it doesn't have to parse
+        # headers itself
+        (data['FromName'], from_address) = woodpecker.Utils.display_address(data['From'])
+        data['ToName'] = woodpecker.Utils.display_address(data['To'])[0]
+        if self.my_addresses.has_key(from_address.lower()):
+            data['Mine'] = 1
+        else:
+            data['Mine'] = 0
+
         data.update(source.get_data())
-        doc.set_data(str(data)) # FIXME: JSON
+        doc.set_data(woodpecker.Data.encode(data, self.data_format))
+        return (qterm, doc)
 
-        self.database.replace_document(qterm, doc)
-        #self._log(".")
+    def _log(self, message, *args):
+        self.logger.log(message, *args)
 
-    def _get_last_index_point(self, mbox):
+class CommitPolicy:
+    """
+    Decides when a Pecker should commit: after a number of documents,
+    after some megabytes of mail, or after some seconds, whichever
+    comes first. With none of them set, we commit after each mbox.
+    """
+    def __init__(self, documents=None, megabytes=None, seconds=None):
+        self.documents = documents
+        self.megabytes = megabytes
+        self.seconds = seconds
+        self.reset()
+
+    def is_set(self):
+        return self.documents!=None or self.megabytes!=None or self.seconds!=None
+
+    def reset(self):
+        self.pending_documents = 0
+        self.pending_bytes = 0
+        self.started = time.time()
+
+    def added(self, nbytes):
+        self.pending_documents += 1
+        self.pending_bytes += nbytes
+
+    def is_due(self):
+        if self.pending_documents==0:
+            return False
+        if self.documents!=None and self.pending_documents >= self.documents:
+            return True
+        if self.megabytes!=None and self.pending_bytes >= self.megabytes * 1024 * 1024:
+            return True
+        if self.seconds!=None and time.time() - self.started >= self.seconds:
+            return True
+        return False
+
+class Pecker(DocumentBuilder):
+    """
+    Keeps the index up to date with mailboxes. Given a shard, it keeps
+    just that shard up to date, passing over messages that belong in
+    others.
+    """
+    def __init__(self, config, verbose=True, full=False, policy=None, shard=None):
+        DocumentBuilder.__init__(self, config, verbose)
+        self.shard = shard
+        if shard==None:
+            self.scheme = None
+            self.database = config.get_writeable_index()
+            self.checkpoints = woodpecker.Utils.Checkpoints(config.checkpointpath)
+            self.manifest = woodpecker.Maildir.Manifest(config.manifestpath)
+            self.threads = woodpecker.Threads.ThreadMap(config.threadpath)
+        else:
+            self.scheme = woodpecker.Shards.Scheme(config)
+            if woodpecker.Shards.is_frozen(config, shard):
+                raise woodpecker.WoodpeckerError("Shard %s is frozen." % shard, "Thaw it first if you really want to change it.")
+            self.database = config.get_writeable_index(shard)
+            path = config.get_shard_dir(shard)
+            self.checkpoints = woodpecker.Utils.Checkpoints(os.path.join(path, 'checkpoints'))
+            self.manifest = woodpecker.Maildir.Manifest(os.path.join(path, 'maildirs'))
+            self.threads = woodpecker.Threads.ThreadMap(os.path.join(path, 'threads'))
+            self.logger.prefix = '[%s] ' % shard
+        self.full = full # ignore checkpoints and index mboxes from the start
+        if policy==None:
+            policy = CommitPolicy()
+        self.policy = policy
+        self.in_transaction = False
+        # (function, args) to call once the current changes are
+        # committed; mbox checkpoints and Maildir manifests mustn't be
+        # written until the changes they cover are
+        self.after_commit = []
+        self.progress_interval = config.progress_interval
+        self.statspath = config.statspath
+        self.forget_missing = config.forget_missing
+        self.last_progress = time.time()
+        # set while someone else (Watch) collects changes to several
+        # mailboxes into one commit of their own
+        self.batching = False
+        # docids of the messages we've seen in the mbox we're reading,
+        # when we're reading all of it; see _sweep()
+        self.marked = None
+        # messages in it that failed before we could tell which they were
+        self.unidentified = 0
+        # the source terms of documents we're rebuilding, by Q-term, so
+        # they remember the other mailboxes they're in
+        self.carried = {}
+
+    def commit(self):
+        """
+        Commit pending changes to the database, then record any mbox
+        checkpoints or Maildir manifests that are now safe.
+        """
+        start = time.time()
+        if self.in_transaction:
+            self.database.commit_transaction()
+            self.in_transaction = False
+        else:
+            self.database.flush()
+        elapsed = time.time() - start
+        self.stats.add('flush', elapsed)
+        if self.policy.pending_documents > 0:
+            self._log("committed %i documents (%.1f MB) in %.2fs.\n", self.policy.pending_documents, self.policy.pending_bytes / 1048576.0, elapsed)
+        self.threads.sync()
+        for (fn, args) in self.after_commit:
+            fn(*args)
+        self.after_commit = []
+        self.policy.reset()
+    flush = commit
+
+    def close(self):
+        self.commit()
+        self.checkpoints.close()
+        self.manifest.close()
+        self.threads.close()
+        DocumentBuilder.close(self)
+        self.report()
+
+    def report(self):
+        """Say where the time went, and write the stats file if we have one."""
+        for line in self.stats.report():
+            self._log("%s\n", line)
+        if self.statspath!=None:
+            self.stats.write(self.statspath)
+
+    def _progress(self):
+        if self.progress_interval==None:
+            return
+        now = time.time()
+        if now - self.last_progress < self.progress_interval:
+            return
+        self.last_progress = now
+        self._log("%s\n", self.stats.progress())
+        if self.statspath!=None:
+            self.stats.write(self.statspath)
+
+    def failed(self, where):
+        """Count, and show, the exception we're in the middle of handling."""
+        self.stats.fail('%s: %s' % (where, sys.exc_info()[0].__name__))
+        import traceback
+        traceback.print_exc()
+
+    def _start_write(self):
+        if (self.policy.is_set() or self.batching) and not self.in_transaction:
+            # Xapian won't auto-flush inside a transaction, so the policy
+            # (or whoever is batching) alone decides how much we hold in
+            # memory
+            self.database.begin_transaction()
+            self.in_transaction = True
+
+    def _end_mailbox(self):
+        """
+        We've finished with a mailbox; with no commit policy, and no
+        batch being collected, that's when we commit.
+        """
+        self.carried = {}
+        if not self.policy.is_set() and not self.batching:
+            self.commit()
+
+    def _replace_document(self, qterm, doc, nbytes=0):
+        for term in self.carried.pop(qterm, ()):
+            doc.add_term(term, 0)
+        self._start_write()
+        t = time.time()
+        docid = self.database.replace_document(qterm, doc)
+        self.stats.add('replace', time.time() - t)
+        self._mark(docid)
+        self.policy.added(nbytes)
+        if self.policy.is_due():
+            self.commit()
+        self._progress()
+
+    def _delete_document(self, docid):
+        self._start_write()
+        self.database.delete_document(docid)
+        self.stats.count('deleted')
+        self.policy.added(0)
+        if self.policy.is_due():
+            self.commit()
+
+    def _find_document(self, qterm):
+        """Return (docid, document) for qterm, or (None, None)."""
+        for item in self.database.postlist(qterm):
+            return (item.docid, self.database.get_document(item.docid))
         return (None, None)
 
-    def _is_incremental_indexable(self, mbox):
+    def _add_thread(self, doc, headers):
+        """
+        Put doc in its thread, given thread_headers() for it. This has
+        to happen in the writer, since it depends on what's gone before.
+        """
+        t = time.time()
+        thread = self.threads.thread_for(*headers)
+        self.stats.add('thread', time.time() - t)
+        doc.add_value(woodpecker.VALUE_THREAD, thread)
+        doc.add_term('XTHREAD' + thread, 0)
+
+    def _in_shard(self, mbox, buf):
+        """Is the raw message in buf, from mbox, one for us to index?"""
+        if self.shard==None or self.scheme.kind==woodpecker.Shards.MAILBOX:
+            # index_mailbox() has already checked
+            return True
+        return self.scheme.shard_for(mbox, buf)==self.shard
+
+    def index_message(self, mess, source, qterm, nbytes=0, fingerprint=None):
+        (qterm, doc) = self.make_document(mess, source, qterm, fingerprint)
+        self._add_thread(doc, woodpecker.Threads.thread_headers(mess))
+        self.stats.count('messages')
+        self.stats.count('bytes', nbytes)
+        self._replace_document(qterm, doc, nbytes)
+        return qterm
+
+    def _refresh_unchanged(self, buf, source):
+        """
+        If the raw message in buf is already indexed with the same
+        content, and built the way we'd build it now, just bring its
+        source details (which mbox, where in it) up to date. Returns
+        (qterm, None) if so, and otherwise (qterm, fingerprint), ready
+        for indexing it properly. With full set, nothing is unchanged.
+        """
+        t = time.time()
+        fingerprint = woodpecker.Utils.message_fingerprint(buf)
+        qterm = self.qterm_for(woodpecker.Utils.message_headers(buf), buf)
+        (docid, doc) = self._find_document(qterm)
+        self.stats.add('check', time.time() - t)
+        if self.full or doc==None or doc.get_value(self.VALUE_FINGERPRINT)!=fingerprint or doc.get_value(self.VALUE_BUILD)!=self.build_key:
+            if doc!=None:
+                self.carried[qterm] = [ t.term for t in doc.termlist() if t.term.startswith(woodpecker.Utils.SOURCE_PREFIX) ]
+            return (qterm, fingerprint)
+        self._mark(docid)
+        self.stats.count('unchanged')
+        self._update_source(qterm, doc, source)
+        return (qterm, None)
+
+    # the terms that go when a message moves (but not its source terms:
+    # it may still be where it was as well)
+    SOURCE_PREFIXES = ('XFILENAME', 'ZXFILENAME', 'XFLAG')
+    # and the data fields; Flags is how get_message() knows a Maildir
+    # message, so mustn't outlive a move into an mbox
+    SOURCE_FIELDS = ('Filename', 'MessageNum', 'Flags')
+
+    def _update_source(self, qterm, doc, source, dropped=()):
+        """
+        Bring the details of where an indexed message lives (doc, for
+        qterm) up to date from source, if they've changed, and forget
+        the mailboxes whose source terms are in dropped.
+        """
+        data = woodpecker.Data.decode(doc.get_data())
+        moved = len(dropped) > 0
+        for term in dropped:
+            doc.remove_term(term)
+        for (key, value) in source.get_data().items():
+            if data.get(key)!=value:
+                moved = True
+        for (slot, value) in source.get_values().items():
+            if doc.get_value(slot)!=value:
+                moved = True
+        if not moved:
+            return
+        self.stats.count('moved')
+        # replace the source terms; nothing else needs to change
+        for term in [ t.term for t in doc.termlist() ]:
+            for prefix in self.SOURCE_PREFIXES:
+                if term.startswith(prefix):
+                    doc.remove_term(term)
+                    break
+        self.indexer.set_document(doc)
+        source.add_terms(self.indexer)
+        for term in source.get_terms():
+            doc.add_term(term, 0)
+        for (slot, value) in source.get_values().items():
+            doc.add_value(slot, value)
+        for key in self.SOURCE_FIELDS:
+            if data.has_key(key):
+                del data[key]
+        data.update(source.get_data())
+        doc.set_data(woodpecker.Data.encode(data, self.data_format))
+        self._replace_document(qterm, doc)
+
+    def migrate_data(self):
+        """
+        Rewrite document data written in older formats (such as the
+        repr() of a dict we used to store) in the current format.
+        """
+        n = 0
+        for docid in xrange(1, self.database.get_lastdocid() + 1):
+            try:
+                doc = self.database.get_document(docid)
+            except xapian.DocNotFoundError:
+                continue
+            s = doc.get_data()
+            if woodpecker.Data.is_current(s, self.data_format):
+                continue
+            try:
+                data = woodpecker.Data.decode(s)
+            except woodpecker.Data.DataError:
+                self._log("can't read data for document %i; skipping.\n", docid)
+                continue
+            doc.set_data(woodpecker.Data.encode(data, self.data_format))
+            self._replace_document(docid, doc, len(s))
+            n+=1
+        self.commit()
+        self._log("Migrated data for %i documents.\n", n)
+
+    # the Q-terms we used to give messages without a Message-ID, made
+    # from a random number, so each time we saw one we indexed it again;
+    # and the one that all those with an empty Message-ID shared
+    RANDOM_QTERM_RE = re.compile(r'Q:[0-9]+@woodpecker\.')
+    EMPTY_QTERM = 'Q:'
+
+    def _old_message(self, docid, doc, unlocated):
+        """
+        The raw text of the message for doc, from merge_duplicates(),
+        or None if we can't read it. A document from an mbox that
+        doesn't say where in it the message is goes in unlocated
+        (filename to {message number: [docid]}) for later instead, and
+        we return None.
+        """
+        data = woodpecker.Data.decode(doc.get_data(), ('Filename', 'MessageNum', 'Flags'))
+        if data.has_key('Flags') or doc.get_value(woodpecker.VALUE_OFFSET)!='':
+            try:
+                return woodpecker.Utils.get_message(doc, True)
+            except woodpecker.WoodpeckerError:
+                return None
+        # never read the whole mbox as if it were the message
+        if data.has_key('Filename') and data.has_key('MessageNum'):
+            unlocated.setdefault(data['Filename'], {}).setdefault(data['MessageNum'], []).append(docid)
+        return None
+
+    def _is_message_for(self, raw, doc):
+        """
+        Is raw the message doc was made from, as far as the headers we
+        stored for it say?
+        """
+        data = woodpecker.Data.decode(doc.get_data(), ('From', 'Title', 'Date'))
+        headers = woodpecker.Utils.message_headers(raw)
+        return data.get('From')==headers.get('from', '') and data.get('Title')==headers.get('subject', '') and data.get('Date')==headers.get('date', '')
+
+    def merge_duplicates(self):
+        """
+        Find the documents for messages without a Message-ID that were
+        given random Q-terms (or that had an empty one, and all shared
+        the same Q-term), and keep just one for each message, under the
+        Q-term it would get now. Documents indexed before we stored
+        where in its mbox each message is are found by their message
+        number, and only if the message there has the headers we stored
+        for them. Documents whose message we can't read any more are
+        left alone.
+        """
+        groups = {}
+        terms = {} # docid to its old Q-term
+        unlocated = {}
+        def add(docid, raw):
+            qterm = self.qterm_for(woodpecker.Utils.message_headers(raw), raw)
+            groups.setdefault(qterm, []).append((docid, terms[docid]))
+
+        old = [ item.term for item in self.database.allterms() if self.RANDOM_QTERM_RE.match(item.term) or item.term==self.EMPTY_QTERM ]
+        for term in old:
+            for item in self.database.postlist(term):
+                terms[item.docid] = term
+                raw = self._old_message(item.docid, self.database.get_document(item.docid), unlocated)
+                if raw!=None:
+                    add(item.docid, raw)
+        for (filename, numbers) in unlocated.items():
+            try:
+                for (num, raw) in woodpecker.Utils.messages_by_number(filename, numbers):
+                    for docid in numbers[num]:
+                        if self._is_message_for(raw, self.database.get_document(docid)):
+                            add(docid, raw)
+            except (IOError, OSError):
+                # the mbox has gone; leave them be
+                pass
+        unreadable = len(terms) - sum([ len(docs) for docs in groups.values() ])
+
+        removed = 0
+        for (qterm, docs) in groups.items():
+            docs.sort()
+            (docid, doc) = self._find_document(qterm)
+            if doc==None:
+                # keep the most recently indexed one, with its new Q-term
+                (docid, term) = docs.pop()
+                doc = self.database.get_document(docid)
+                doc.remove_term(term)
+                doc.add_term(qterm)
+                self._replace_document(docid, doc)
+            for (docid, term) in docs:
+                self._delete_document(docid)
+                removed+=1
+        self.commit()
+        self._log("Merged duplicates: %i messages without a Message-ID, %i documents removed, %i unreadable.\n", len(groups), removed, unreadable)
+
+    def _mark(self, docid):
+        if self.marked!=None:
+            self.marked[docid] = True
+
+    def _failed_message(self, qterm):
+        """
+        We couldn't index a message from the mbox we're reading. If we
+        know its Q-term, whatever we have for it isn't to be swept;
+        otherwise we can't tell what's gone from the mbox this time.
+        """
+        if qterm==None:
+            self.unidentified+=1
+            return
+        (docid, doc) = self._find_document(qterm)
+        if docid!=None:
+            self._mark(docid)
+
+    def _is_from(self, doc, filename):
+        """Was doc's message last seen at filename (an absolute path)?"""
+        # older documents can have a path relative to wherever we were run
+        data = woodpecker.Data.decode(doc.get_data(), ('Filename',))
+        return data.has_key('Filename') and os.path.abspath(data['Filename'])==filename
+
+    def _source_docids(self, filename):
+        """The docids of the documents for messages last seen in filename."""
+        # the XFILENAME terms narrow things down, but they're made from
+        # the words of the path, so check the documents they find. Only
+        # the words of its last part are sure to be there, however the
+        # path was given when it was indexed.
+        scratch = xapian.Document()
+        self.indexer.set_document(scratch)
+        woodpecker.Utils.MBoxSource(os.path.basename(filename), 0).add_terms(self.indexer)
+        terms = [ t.term for t in scratch.termlist() if t.term.startswith('XFILENAME') ]
+        if not terms:
+            return []
+        terms.sort(lambda a, b: cmp(self.database.get_termfreq(a), self.database.get_termfreq(b)))
+        filename = os.path.abspath(filename)
+        docids = []
+        for item in self.database.postlist(terms[0]):
+            if self._is_from(self.database.get_document(item.docid), filename):
+                docids.append(item.docid)
+        return docids
+
+    def _sweep(self, mbox):
+        """
+        Having been through all of mbox, marking the documents for the
+        messages we found, delete the documents for any others we last
+        saw there: they've gone.
+        """
+        removed = 0
+        lost = {}
+        for docid in self._source_docids(mbox):
+            if not self.marked.has_key(docid):
+                if self._lost(docid, self.database.get_document(docid), mbox, lost):
+                    removed+=1
+        removed += self._rehome(lost)
+        if removed:
+            self._log("%s: %i messages gone.\n", mbox, removed)
+
+    def _lost(self, docid, doc, mailbox, lost):
+        """
+        The message for doc, last seen in mailbox (an mbox or Maildir),
+        isn't there any more. If we've never seen it anywhere else,
+        delete it and return True. Otherwise add it to lost, for
+        _rehome() to find it again.
+        """
+        gone = woodpecker.Utils.source_term(mailbox)
+        qterm = None
+        others = []
+        dropped = []
+        for t in doc.termlist():
+            if t.term.startswith('Q:'):
+                qterm = t.term
+            elif t.term==gone:
+                dropped.append(t.term)
+            elif t.term.startswith(woodpecker.Utils.SOURCE_PREFIX):
+                others.append(t.term)
+        if not others or qterm==None:
+            self._delete_document(docid)
+            return True
+        lost[docid] = (qterm, others, dropped)
         return False
 
-    def _update_last_index_point(self, mbox, nmessages):
+    def _rehome(self, lost):
+        """
+        Find the messages in lost (from _lost()) in the other mailboxes
+        we've seen them in, and point their documents there; delete
+        those we can't find anywhere. We go through each mailbox at most
+        once, however many messages we're looking for in it. Returns
+        how many we deleted.
+        """
+        if not lost:
+            return 0
+        mailboxes = {}
+        for path in self.checkpoints.mboxes() + self.manifest.maildirs():
+            mailboxes[woodpecker.Utils.source_term(path)] = path
+        removed = 0
+        while lost:
+            # look where most of them might be first
+            counts = {}
+            for (qterm, others, dropped) in lost.values():
+                for term in others:
+                    counts[term] = counts.get(term, 0) + 1
+            best = max([ (n, term) for (term, n) in counts.items() ])[1]
+            wanted = {}
+            for (docid, (qterm, others, dropped)) in lost.items():
+                if best in others:
+                    wanted[qterm] = docid
+            found = {}
+            if mailboxes.has_key(best):
+                found = self._find_messages(mailboxes[best], wanted)
+            for (qterm, docid) in wanted.items():
+                (qterm, others, dropped) = lost[docid]
+                if found.has_key(qterm):
+                    del lost[docid]
+                    self._update_source(qterm, self.database.get_document(docid), found[qterm], dropped)
+                    continue
+                others.remove(best)
+                dropped.append(best)
+                if not others:
+                    del lost[docid]
+                    self._delete_document(docid)
+                    removed+=1
+        return removed
+
+    def _find_messages(self, mailbox, wanted):
+        """
+        Look through mailbox (an mbox or Maildir) for the messages whose
+        Q-terms are keys of wanted, returning a dict mapping the Q-term
+        of each we find to where it is (a Utils.MBoxSource or
+        MaildirSource).
+        """
+        found = {}
+        if woodpecker.Maildir.is_maildir(mailbox):
+            # the manifest knows which is which
+            for (relpath, ino, size, mtime, qterm) in self.manifest.get(mailbox).values():
+                filename = os.path.join(mailbox, relpath)
+                if wanted.has_key(qterm) and os.path.exists(filename):
+                    found[qterm] = woodpecker.Utils.MaildirSource(filename)
+            return found
+        try:
+            fp = file(mailbox)
+        except IOError:
+            return found
+        try:
+            scanner = woodpecker.MBox.MBoxScanner(fp, 0, os.fstat(fp.fileno()).st_size)
+            num = 0
+            for (offset, length, buf) in scanner:
+                qterm = self.qterm_for(woodpecker.Utils.message_headers(buf), buf)
+                if wanted.has_key(qterm):
+                    found[qterm] = woodpecker.Utils.MBoxSource(mailbox, num, offset, length)
+                num+=1
+            scanner.close()
+        finally:
+            fp.close()
+        return found
+
+    def sweep_missing(self, paths, roots=None):
+        """
+        Delete the documents for mboxes and Maildirs under paths that
+        we've indexed before but that aren't there any more. If one of
+        roots, the paths we were asked to index (by default, paths
+        themselves), has gone, that could just be a disk that isn't
+        mounted, or a typo, so unless forget_missing is set we leave
+        everything under it alone.
+        """
+        if roots==None:
+            roots = paths
+        missing = []
+        for root in roots:
+            if not os.path.exists(root) and not self.forget_missing:
+                self._log("%s: not there; keeping what we had from it (use --forget-missing to drop it).\n", root)
+                missing.append(os.path.abspath(root).rstrip(os.sep))
+        prefixes = []
+        for path in paths:
+            path = os.path.abspath(path).rstrip(os.sep)
+            if not _is_under(path, missing):
+                prefixes.append(path)
+
+        for mbox in self.checkpoints.mboxes():
+            if _is_under(mbox, prefixes) and not os.path.exists(mbox):
+                self.marked = {}
+                self._sweep(mbox)
+                self.marked = None
+                self.after_commit.append((self.checkpoints.forget, (mbox,)))
+        for maildir in self.manifest.maildirs():
+            if not _is_under(maildir, prefixes) or os.path.exists(maildir):
+                continue
+            removed = 0
+            lost = {}
+            for (relpath, ino, size, mtime, qterm) in self.manifest.get(maildir).values():
+                if qterm==None:
+                    continue
+                (docid, doc) = self._find_document(qterm)
+                # only if it hasn't turned up somewhere else since
+                if doc!=None and self._is_from(doc, os.path.join(maildir, relpath)):
+                    if self._lost(docid, doc, maildir, lost):
+                        removed+=1
+            removed += self._rehome(lost)
+            self._log("%s: gone [%i].\n", maildir, removed)
+            self.after_commit.append((self.manifest.forget, (maildir,)))
+        self._end_mailbox()
+
+    def _get_last_index_point(self, mbox):
+        """
+        Return (offset, nmessages, qterm) to resume mbox from, where
+        qterm is that of the message we found at offset last time, if
+        any; or (None, None, None) if it has to be indexed from the
+        start.
+        """
+        if self.full or not self._is_incremental_indexable(mbox):
+            return (None, None, None)
+        point = self.checkpoints.get(mbox)
+        if point==None:
+            return (None, None, None)
+        if not self.checkpoints.is_valid(mbox, point):
+            self._log("%s: rewritten since last time; reindexing.\n", mbox)
+            self.checkpoints.forget(mbox)
+            return (None, None, None)
+        return (point['offset'], point['count'], point.get('last'))
+
+    def _is_incremental_indexable(self, mbox):
+        return self.checkpoints!=None and os.path.isfile(mbox)
+
+    def _update_last_index_point(self, mbox, fp, offset, nmessages, last=None):
+        point = self.checkpoints.make_point(fp, offset, nmessages, last)
+        self.after_commit.append((self.checkpoints.set, (mbox, point)))
+
+    def _drop_partial(self, mbox, offset, qterm):
+        """
+        Last time, the message at offset in mbox was the last one, and
+        had qterm; it may have been only partly written then. If what's
+        there now isn't that message, and its document still says it's
+        there, it was made from part of the one we've just read.
+        """
+        (docid, doc) = self._find_document(qterm)
+        if doc!=None and not self.marked.has_key(docid) and self._is_from(doc, mbox) and doc.get_value(woodpecker.VALUE_OFFSET)==str(offset):
+            lost = {}
+            self._lost(docid, doc, mbox, lost)
+            self._rehome(lost)
+
+    def _index_messages(self, scanner, mbox, num):
+        """
+        Index all the messages from scanner (an MBoxScanner on mbox),
+        numbering them from num. Returns the number of the next message.
+        """
+        t = time.time()
+        for (offset, length, buf) in scanner:
+            self.stats.add('scan', time.time() - t)
+            self.last_qterm = None
+            if not self._in_shard(mbox, buf):
+                num+=1
+                t = time.time()
+                continue
+            source = woodpecker.Utils.MBoxSource(mbox, num, offset, length)
+            qterm = None
+            try:
+                (qterm, fingerprint) = self._refresh_unchanged(buf, source)
+                if fingerprint!=None:
+                    mess = self._parse(buf)
+                    if mess!="":
+                        self.index_message(mess, source, qterm, length, fingerprint)
+                    else:
+                        self._failed_message(qterm)
+            except KeyboardInterrupt:
+                raise
+            except:
+                self.failed('message')
+                self._failed_message(qterm)
+            self.last_qterm = qterm
+            num+=1
+            t = time.time()
+        return num
+
+    def _parse(self, buf):
+        mess = self.parse_message(buf)
+        if mess=="":
+            self.stats.fail('parse: unparseable')
+        return mess
+
+    def _index_raw(self, buf, source, qterm, fingerprint, done=None):
+        """
+        Index the raw message in buf (string or buffer), which
+        _refresh_unchanged() said needs building. If that works, call
+        done, a (function, args) pair, if given. A ParallelPecker hands
+        the message to its workers, so it may not be indexed until
+        _flush_raw().
+        """
+        mess = self._parse(buf)
+        if mess=="":
+            return
+        self.index_message(mess, source, qterm, len(buf), fingerprint)
+        if done!=None:
+            (function, args) = done
+            function(*args)
+
+    def _flush_raw(self):
+        """Finish indexing whatever _index_raw() has been given."""
         pass
 
+    def index_maildir(self, maildir):
+        """
+        Bring the index up to date with a Maildir: index new messages,
+        update those that have been renamed (moved from new/ to cur/,
+        or had their flags changed), and remove those that have gone.
+        """
+        old = self.manifest.get(maildir)
+        if self.full:
+            old = {}
+        entries = {}
+        added = 0
+        renamed = 0
+        for (unique, relpath) in woodpecker.Maildir.list_maildir(maildir).items():
+            entry = old.get(unique)
+            if entry!=None and entry[0]==relpath:
+                entries[unique] = entry
+                continue
+            filename = os.path.join(maildir, relpath)
+            source = woodpecker.Utils.MaildirSource(filename)
+            try:
+                if entry!=None:
+                    # same message, new name; the content can't have changed
+                    qterm = entry[4]
+                    if qterm!=None:
+                        (docid, doc) = self._find_document(qterm)
+                        if doc!=None:
+                            self._update_source(qterm, doc, source)
+                    st = os.stat(filename)
+                    renamed+=1
+                else:
+                    fp = file(filename, 'rb')
+                    try:
+                        st = os.fstat(fp.fileno())
+                        if st.st_size > BIG_MESSAGE:
+                            # parse_message() only needs some of it
+                            buf = mmap.mmap(fp.fileno(), st.st_size, access=mmap.ACCESS_READ)
+                        else:
+                            buf = fp.read()
+                    finally:
+                        fp.close()
+                    if not self._in_shard(maildir, buf):
+                        # another shard's; remember we've seen it
+                        entries[unique] = (relpath, st.st_ino, st.st_size, st.st_mtime, None)
+                        continue
+                    (qterm, fingerprint) = self._refresh_unchanged(buf, source)
+                    added+=1
+                    if fingerprint!=None:
+                        # only remember it once it's indexed
+                        entry = (relpath, st.st_ino, st.st_size, st.st_mtime, qterm)
+                        self._index_raw(buf, source, qterm, fingerprint, (entries.__setitem__, (unique, entry)))
+                        continue
+                entries[unique] = (relpath, st.st_ino, st.st_size, st.st_mtime, qterm)
+            except KeyboardInterrupt:
+                raise
+            except:
+                self.failed('maildir message')
+        self._flush_raw()
+
+        removed = 0
+        lost = {}
+        present = None
+        for (unique, entry) in old.items():
+            if entries.has_key(unique) or entry[4]==None:
+                continue
+            (docid, doc) = self._find_document(entry[4])
+            # only if it hasn't turned up somewhere else since
+            if doc==None or not self._is_from(doc, os.path.join(maildir, entry[0])):
+                continue
+            if present==None:
+                present = {}
+                for (relpath, ino, size, mtime, qterm) in entries.values():
+                    present[qterm] = relpath
+            if present.has_key(entry[4]):
+                # another copy here
+                self._update_source(entry[4], doc, woodpecker.Utils.MaildirSource(os.path.join(maildir, present[entry[4]])))
+            elif self._lost(docid, doc, maildir, lost):
+                removed+=1
+        removed += self._rehome(lost)
+
+        self._log("%s: done [%i, %i new, %i renamed, %i gone].\n", maildir, len(entries), added, renamed, removed)
+        self.stats.count('mailboxes')
+        self.after_commit.append((self.manifest.set, (maildir, entries)))
+        self._end_mailbox()
+
     def index_mailbox(self, mbox):
+        """
+        Index an mbox, a Maildir, a directory of either, or a list of
+        any of those.
+        """
         if type(mbox) is list:
             for one_mbox in mbox:
-                self.index_mailbox(one_mbox)
-            self._log('Done %i mailboxes.\n' % len(mbox))
+                if os.path.exists(one_mbox):
+                    self.index_mailbox(one_mbox)
+            # including any of them that have gone
+            self.sweep_missing(mbox)
+            self._log("Done %i mailboxes.\n", len(mbox))
+            return
+
+        # so documents say where their messages are whatever directory
+        # we're run from, and _sweep() can find them again
+        mbox = os.path.abspath(mbox)
+        if not os.path.exists(mbox):
+            self.sweep_missing([mbox])
+            return
+
+        if os.path.isdir(mbox):
+            if woodpecker.Maildir.is_maildir(mbox):
+                if self.shard==None or self.scheme.may_contain(self.shard, mbox):
+                    self.index_maildir(mbox)
+                for folder in woodpecker.Maildir.subfolders(mbox):
+                    self.index_mailbox(folder)
+            else:
+                names = os.listdir(mbox)
+                names.sort()
+                for name in names:
+                    if not name.startswith('.'):
+                        self.index_mailbox(os.path.join(mbox, name))
             return
 
-        self._log("%s: " % mbox)
+        if self.shard!=None and not self.scheme.may_contain(self.shard, mbox):
+            return
         _fp = file(mbox)
+        # only look at what's there now; anything appended while we're
+        # running will get picked up next time
+        size = os.fstat(_fp.fileno()).st_size
         # get index point and num emails in mbox up to index point
-        tpl = self._get_last_index_point(mbox)
-        if tpl[0]==None:
+        (start, num, last) = self._get_last_index_point(mbox)
+        if start==None:
+            start = 0
             num = 0
-            fp = _fp
-        else:
-            num = tpl[1]
-            fp = woodpecker.Utils.Subfile(_fp, tpl[0])
+        if start==size:
+            _fp.close()
+            if start==0:
+                # emptied
+                self.marked = {}
+                self._sweep(mbox)
+                self.marked = None
+            self._log("%s: unchanged [%i].\n", mbox, num)
+            return
+        scanner = woodpecker.MBox.MBoxScanner(_fp, start, size)
+        first = num
+        # if we're going through all of it, we can tell which messages
+        # have gone; otherwise, whether the last one has changed
+        self.marked = {}
+        self.unidentified = 0
+        self.last_qterm = None
+        complete = False
         try:
-            m = mailbox.PortableUnixMailbox(fp, woodpecker.Utils.msgfactory)
-            num = 0
-            while True:
-                mess = m.next()
-                if mess==None:
-                    break
-                if mess=="":
-                    continue
-
-                try:
-                    self.index_message(mess, woodpecker.Utils.MBoxSource(mbox, num))
-                except KeyboardInterrupt:
-                    raise
-                except:
-                    import traceback
-                    traceback.print_exc()
-                num+=1
+            num = self._index_messages(scanner, mbox, num)
+            complete = True
         except KeyboardInterrupt:
+            self.marked = None
             raise
         except:
-            import traceback
-            traceback.print_exc()
-            pass
+            self.failed('mailbox')
+        scanner.close()
+        # unless we know what every message so far was, leave things so
+        # next time we look at them all again
+        complete = complete and self.unidentified==0
+        if complete and self._is_incremental_indexable(mbox):
+            # only up to the start of the last message, which could still
+            # be arriving; we'll read it again next time. And from the
+            # file we've just read, even if it's been replaced.
+            if scanner.last==None:
+                self._update_last_index_point(mbox, _fp, size, num)
+            else:
+                self._update_last_index_point(mbox, _fp, scanner.last, num - 1, self.last_qterm)
         _fp.close()
-        self._log("done [%i].\n" % num, False)
-        self.flush()
-        if self._is_incremental_indexable(mbox):
-            self._update_last_index_point(mbox, num)
+        if complete and start==0:
+            self._sweep(mbox)
+        elif complete and last!=None:
+            self._drop_partial(mbox, start, last)
+        self.marked = None
+        self._log("%s: done [%i, %i new].\n", mbox, num, num - first)
+        self.stats.count('mailboxes')
+        self._end_mailbox()
+
+def flatten_document(doc):
+    """
+    Reduce a xapian.Document to plain Python data, so it can be shipped
+    between processes: (data, [(term, wdf, [positions])], [(slot, value)]).
+    """
+    terms = []
+    for t in doc.termlist():
+        terms.append((t.term, t.wdf, list(t.positer)))
+    values = []
+    for v in doc.values():
+        values.append((v.num, v.value))
+    return (doc.get_data(), terms, values)
+
+def unflatten_document(flat):
+    """Rebuild a xapian.Document from flatten_document()'s output."""
+    (data, terms, values) = flat
+    doc = xapian.Document()
+    doc.set_data(data)
+    for (term, wdf, positions) in terms:
+        for pos in positions:
+            doc.add_posting(term, pos, 0)
+        doc.add_term(term, wdf)
+    for (slot, value) in values:
+        doc.add_value(slot, value)
+    return doc
+
+# Each worker process in a ParallelPecker's pool gets its own builder.
+_worker_builder = None
 
-    def _log(self, message, include_timestamp=True):
-        self.logger.log(message, include_timestamp)
+def _init_worker(config):
+    global _worker_builder
+    _worker_builder = DocumentBuilder(config, False)
+
+def _build_worker(args):
+    """
+    Parse and build one message (from an mbox or a Maildir, as source
+    says) in a worker process. Returns
+    (qterm, flattened document, nbytes, thread headers, None, stats) or
+    (None, None, nbytes, None, (failure category, traceback, qterm),
+    stats), where stats are from Stats.take().
+    """
+    (raw, truncated, source, nbytes, qterm, fingerprint) = args
+    stats = _worker_builder.stats
+    try:
+        mess = _worker_builder.parse_message(raw)
+        if mess=="":
+            raise email.Errors.MessageParseError("unparseable")
+        mess.truncated_parts += truncated
+        (qterm, doc) = _worker_builder.make_document(mess, source, qterm, fingerprint)
+        return (qterm, flatten_document(doc), nbytes, woodpecker.Threads.thread_headers(mess), None, stats.take())
+    except KeyboardInterrupt:
+        raise
+    except:
+        import traceback
+        category = 'build: %s' % sys.exc_info()[0].__name__
+        return (None, None, nbytes, None, (category, traceback.format_exc(), qterm), stats.take())
+
+class ParallelPecker(Pecker):
+    """
+    A Pecker that farms parsing and term generation for each message
+    out to a pool of worker processes, and just writes the finished
+    documents to the database itself.
+    """
+    BATCH_PER_JOB = 64
+
+    def __init__(self, config, verbose=True, full=False, policy=None, jobs=2, shard=None):
+        Pecker.__init__(self, config, verbose, full, policy, shard)
+        import multiprocessing
+        self.jobs = jobs
+        self.pool = multiprocessing.Pool(jobs, _init_worker, (config,))
+        # from _index_raw(): (worker args, done) pairs
+        self.raw_batch = []
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        Pecker.close(self)
+
+    def _batches(self, scanner, mbox, num):
+        """
+        Yield (batch, num) for batches of messages from scanner that
+        need building, where num is the number of the next message. We
+        read a batch at a time so we don't pull the whole mbox into
+        memory ahead of the workers.
+        """
+        batch = []
+        t = time.time()
+        for (offset, length, buf) in scanner:
+            self.stats.add('scan', time.time() - t)
+            self.last_qterm = None
+            if not self._in_shard(mbox, buf):
+                num+=1
+                t = time.time()
+                continue
+            qterm = None
+            source = woodpecker.Utils.MBoxSource(mbox, num, offset, length)
+            try:
+                (qterm, fingerprint) = self._refresh_unchanged(buf, source)
+            except KeyboardInterrupt:
+                raise
+            except:
+                self.failed('message')
+                self._failed_message(qterm)
+                fingerprint = None
+            if fingerprint!=None:
+                # big messages are cut down here, so we don't copy all
+                # of them to the workers
+                (raw, truncated) = self.cut_message(buf)
+                batch.append((raw, truncated, source, length, qterm, fingerprint))
+            self.last_qterm = qterm
+            num+=1
+            if len(batch) >= self.jobs * self.BATCH_PER_JOB:
+                yield (batch, num)
+                batch = []
+            t = time.time()
+        yield (batch, num)
+
+    def _write_batch(self, results, dones=None):
+        """
+        Write the documents the workers built. dones, if given, has a
+        (function, args) pair or None for each result, to call if that
+        one worked; see _index_raw().
+        """
+        if dones==None:
+            dones = [None] * len(results)
+        for ((qterm, flat, nbytes, headers, error, stats), done) in zip(results, dones):
+            self.stats.merge(stats)
+            if qterm==None:
+                self.stats.fail(error[0])
+                sys.stderr.write(error[1])
+                self._failed_message(error[2])
+                continue
+            doc = unflatten_document(flat)
+            self._add_thread(doc, headers)
+            self.stats.count('messages')
+            self.stats.count('bytes', nbytes)
+            self._replace_document(qterm, doc, nbytes)
+            if done!=None:
+                (function, args) = done
+                function(*args)
+
+    def _index_raw(self, buf, source, qterm, fingerprint, done=None):
+        # big messages are cut down here, as in _batches()
+        (raw, truncated) = self.cut_message(buf)
+        self.raw_batch.append(((raw, truncated, source, len(buf), qterm, fingerprint), done))
+        if len(self.raw_batch) >= self.jobs * self.BATCH_PER_JOB:
+            self._flush_raw()
+
+    def _flush_raw(self):
+        batch = self.raw_batch
+        self.raw_batch = []
+        if not batch:
+            return
+        results = self.pool.map(_build_worker, [ args for (args, done) in batch ], self.BATCH_PER_JOB / 4)
+        self._write_batch(results, [ done for (args, done) in batch ])
+
+    def _index_messages(self, scanner, mbox, num):
+        # keep the workers busy on the next batch while we write this one
+        pending = None
+        for (batch, num) in self._batches(scanner, mbox, num):
+            if not batch:
+                continue
+            result = self.pool.map_async(_build_worker, batch, self.BATCH_PER_JOB / 4)
+            if pending!=None:
+                self._write_batch(pending.get())
+            pending = result
+        if pending!=None:
+            self._write_batch(pending.get())
+        return num
 
 def usage():
-    print u"Usage: %s [options] mbox..." % sys.argv[0]
+    print u"Usage: %s [options] mbox|maildir|directory..." % sys.argv[0]
     print u"Options:"
     print u"\t--help\t\tThis message"
     print u"\t--confdir d\tUse ``d'' instead of ~/.woodpecker"
     print u"\t--quiet\tDon't shout about things that are dull"
+    print u"\t--full\t\tReindex everything, ignoring checkpoints and manifests"
+    print u"\t--forget-missing\tRemove messages from mailboxes we're given that have gone"
+    print u"\t--jobs n\tParse and build documents in n worker processes"
+    print u"\t--html-converter c\tConvert HTML with c (builtin or elinks;\n\t\t\tdefault from html-converter in the confdir)"
+    print u"\t--data-format f\tStore document data as f (binary or json)"
+    print u"\t--migrate-data\tRewrite document data in older formats"
+    print u"\t--merge-duplicates\tMerge the copies of messages without a Message-ID"
+    print u"\t\t\tthat older versions indexed each time they saw them"
+    print u"\t--watch\t\tKeep running, indexing changes as they happen"
+    print u"\t--debounce t\tWhen watching, wait for t seconds of quiet (default 5)"
+    print u"\t--commit-docs n\tCommit every n documents"
+    print u"\t--commit-mb m\tCommit every m megabytes of mail"
+    print u"\t--commit-secs t\tCommit every t seconds"
+    print u"\t\t\t(default: commit at the end of each mbox)"
+    print u"\t--progress t\tShow progress every t seconds (default 60; 0 for never)"
+    print u"\t--stats f\tWrite timings and counts to f as JSON, as we go and at the end"
+    print u"\t--no-attachments\tDon't index the text of attachments"
+    print u"\t--attachment-jobs n\tExtract attachment text in n processes (default 2;"
+    print u"\t\t\t0 to do it in-line)"
+    print u"\t--attachment-timeout t\tGive up on an attachment after t seconds"
+    print u"\t--maintain\tCompact the index and show what's in it, instead of indexing"
+    print u"\t--by-date\tWhen maintaining, renumber documents in date order too"
+    print u"\t--shard s\tOnly bring shard s up to date (default: all of them)"
+    print u"\t--compact-shard s\tCompact shard s"
+    print u"\t--freeze-shard s\tCompact shard s and stop writing to it"
+    print u"\t--thaw-shard s\tAllow shard s to be written to again"
 
 def main():
     """
@@ -239,13 +1400,32 @@ def main():
     """
     try:
         try:
-            optlist, args = getopt.getopt(sys.argv[1:], 'hc:q', ['help', 'confdir=', 'quiet'])
+            optlist, args = getopt.getopt(sys.argv[1:], 'hc:qfj:w', ['help', 'confdir=', 'quiet', 'full', 'jobs=', 'html-converter=', 'data-format=', 'migrate-data', 'merge-duplicates', 'watch', 'debounce=', 'commit-docs=', 'commit-mb=', 'commit-secs=', 'progress=', 'stats=', 'no-attachments', 'attachment-jobs=', 'attachment-timeout=', 'forget-missing', 'maintain', 'by-date', 'shard=', 'compact-shard=', 'freeze-shard=', 'thaw-shard='])
         except getopt.GetoptError:
             usage()
             sys.exit(2)
 
         confdir = None
         verbose = True
+        full = False
+        jobs = 1
+        policy = CommitPolicy()
+        html_converter = None
+        data_format = None
+        migrate = False
+        merge = False
+        watch = False
+        debounce = 5
+        progress = -1
+        statspath = None
+        extract_attachments = True
+        forget_missing = False
+        attachment_jobs = None
+        attachment_timeout = None
+        maintain = False
+        by_date = False
+        shard = None
+        shard_action = None
 
         for opt, arg in optlist:
             if opt in ('-h', '--help'):
@@ -255,15 +1435,130 @@ def main():
                 verbose = False
             if opt in ('-c', '--confdir'):
                 confdir = arg
+            if opt in ('-f', '--full'):
+                full = True
+            if opt=='--html-converter':
+                html_converter = arg
+            if opt=='--data-format':
+                if arg not in woodpecker.Data.FORMATS:
+                    usage()
+                    sys.exit(2)
+                data_format = arg
+            if opt=='--migrate-data':
+                migrate = True
+            if opt=='--merge-duplicates':
+                merge = True
+            if opt in ('-w', '--watch'):
+                watch = True
+            if opt=='--stats':
+                statspath = arg
+            if opt=='--no-attachments':
+                extract_attachments = False
+            if opt=='--forget-missing':
+                forget_missing = True
+            if opt=='--maintain':
+                maintain = True
+            if opt=='--by-date':
+                by_date = True
+            if opt=='--shard':
+                shard = arg
+            if opt in ('--compact-shard', '--freeze-shard', '--thaw-shard'):
+                shard_action = (opt[2:opt.index('-shard')], arg)
+            try:
+                if opt in ('-j', '--jobs'):
+                    jobs = int(arg)
+                if opt=='--commit-docs':
+                    policy.documents = int(arg)
+                if opt=='--commit-mb':
+                    policy.megabytes = float(arg)
+                if opt=='--commit-secs':
+                    policy.seconds = float(arg)
+                if opt=='--debounce':
+                    debounce = float(arg)
+                if opt=='--progress':
+                    progress = float(arg)
+                if opt=='--attachment-jobs':
+                    attachment_jobs = int(arg)
+                if opt=='--attachment-timeout':
+                    attachment_timeout = float(arg)
+            except ValueError:
+                usage()
+                sys.exit(2)
 
         conf = woodpecker.Config(confdir)
-        pecker = Pecker(conf, verbose)
+        if html_converter!=None:
+            conf.html_converter = html_converter
+        if data_format!=None:
+            conf.data_format = data_format
+        if progress==0:
+            conf.progress_interval = None
+        elif progress > 0:
+            conf.progress_interval = progress
+        if statspath!=None:
+            conf.statspath = statspath
+        conf.extract_attachments = extract_attachments
+        conf.forget_missing = forget_missing
+        if attachment_jobs!=None:
+            conf.attachment_jobs = attachment_jobs
+        if attachment_timeout!=None:
+            conf.attachment_timeout = attachment_timeout
+
+        if shard_action!=None:
+            (action, name) = shard_action
+            getattr(woodpecker.Shards, action)(conf, name)
+            return
+        if maintain:
+            if conf.sharding==None:
+                paths = [('index', conf.dbpath)]
+            elif shard!=None:
+                paths = [(shard, os.path.join(conf.get_shard_dir(shard), 'index'))]
+            else:
+                paths = [ (name, os.path.join(conf.get_shard_dir(name), 'index')) for name in conf.get_shards() ]
+            for (name, path) in paths:
+                print "%s:" % name
+                for line in woodpecker.Maintenance.maintain(path, by_date):
+                    print "  %s" % line
+            return
+        if conf.sharding!=None and shard==None:
+            if watch:
+                raise woodpecker.WoodpeckerError("Can't watch all the shards at once.", "Use --shard to pick one.")
+            if migrate or merge:
+                for name in conf.get_shards():
+                    if not woodpecker.Shards.is_frozen(conf, name):
+                        pecker = Pecker(conf, verbose, full, policy, name)
+                        if migrate:
+                            pecker.migrate_data()
+                        if merge:
+                            pecker.merge_duplicates()
+                        pecker.close()
+            stats = woodpecker.Shards.build(conf, args, verbose, full, policy, jobs)
+            logger = woodpecker.Utils.Logger(verbose)
+            for line in stats.report():
+                logger.log("%s\n", line)
+            if conf.statspath!=None:
+                stats.write(conf.statspath)
+            return
+        if shard!=None and conf.sharding==None:
+            raise woodpecker.WoodpeckerError("The index isn't sharded.", "Put 'year' or 'mailbox' in %s to shard it." % os.path.join(conf.configpath, 'sharding'))
+
+        if jobs > 1:
+            pecker = ParallelPecker(conf, verbose, full, policy, jobs, shard)
+        else:
+            pecker = Pecker(conf, verbose, full, policy, shard)
 
         try:
-            pecker.index_mailbox(args)
+            if migrate:
+                pecker.migrate_data()
+            if merge:
+                pecker.merge_duplicates()
+            if watch:
+                woodpecker.Watch.make_watcher(pecker, args, debounce).run()
+            else:
+                pecker.index_mailbox(args)
         except:
             import traceback
             traceback.print_exc()
+        pecker.close()
     except woodpecker.WoodpeckerError, e:
         sys.stdout.write(str(e))
         sys.stdout.write("\n")
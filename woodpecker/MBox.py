@@ -0,0 +1,87 @@
+# Woodpecker mbox scanning
+#
+# (c) Copyright James Aylett 2008
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+"""
+Fast mbox scanning. Rather than reading the mbox a line at a time
+(which is what mailbox.PortableUnixMailbox does), we mmap it and look
+for "From " separators with find(), handing back each message as a
+buffer onto the mapping so nothing gets copied until it's parsed.
+"""
+
+import mmap
+
+SEPARATOR = '\nFrom '
+
+class MBoxScanner:
+    """
+    Iterate over the messages in an open mbox file, between byte
+    offsets start and stop (by default, the whole file), yielding
+    (offset, length, buffer) for each one. Like PortableUnixMailbox,
+    any line starting "From " starts a new message; the message
+    includes its "From " line.
+
+    start should be the start of a message (say, a checkpoint from
+    last time); if it isn't, we skip forward to the next separator.
+    Afterwards, last is the offset of the last message we found (which
+    may not have been completely written yet), or None.
+    """
+    def __init__(self, fp, start=0, stop=None):
+        self.fp = fp
+        if stop==None:
+            fp.seek(0, 2)
+            stop = fp.tell()
+        self.start = start
+        self.stop = stop
+        self.last = None
+        if stop > 0:
+            self.map = mmap.mmap(fp.fileno(), stop, access=mmap.ACCESS_READ)
+        else:
+            # can't mmap an empty file
+            self.map = None
+
+    def _first(self):
+        if self.start==0 and self.map[0:5]=='From ':
+            return 0
+        if self.start > 0 and self.map[self.start - 1:self.start + 5]==SEPARATOR:
+            return self.start
+        idx = self.map.find(SEPARATOR, max(0, self.start - 1), self.stop)
+        if idx==-1:
+            return -1
+        return idx + 1
+
+    def __iter__(self):
+        if self.map==None or self.start >= self.stop:
+            return
+        offset = self._first()
+        if offset==-1:
+            return
+        while offset < self.stop:
+            idx = self.map.find(SEPARATOR, offset, self.stop)
+            if idx==-1:
+                end = self.stop
+            else:
+                end = idx + 1
+            self.last = offset
+            yield (offset, end - offset, buffer(self.map, offset, end - offset))
+            offset = end
+
+    def close(self):
+        if self.map!=None:
+            self.map.close()
+            self.map = None
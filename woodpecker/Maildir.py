@@ -0,0 +1,98 @@
+# Woodpecker Maildir support
+#
+# (c) Copyright James Aylett 2008
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+"""
+Maildir support. A message in a Maildir never changes once it's been
+delivered; it just gets renamed, when it moves from new/ to cur/ or
+its flags change. So to keep up to date all we need to notice is
+names appearing, changing and disappearing, which we do by comparing
+a directory listing with a manifest of what we saw last time.
+"""
+
+import os, shelve
+
+def is_maildir(path):
+    for sub in ('cur', 'new', 'tmp'):
+        if not os.path.isdir(os.path.join(path, sub)):
+            return False
+    return True
+
+def split_name(name):
+    """Split a Maildir file name into (unique name, flags)."""
+    idx = name.find(':')
+    if idx==-1:
+        return (name, '')
+    info = name[idx+1:]
+    if info.startswith('2,'):
+        return (name[:idx], info[2:])
+    return (name[:idx], '')
+
+def list_maildir(path):
+    """
+    Map the unique name of every message in a Maildir to its path
+    relative to the Maildir.
+    """
+    messages = {}
+    for sub in ('new', 'cur'):
+        for name in os.listdir(os.path.join(path, sub)):
+            if name.startswith('.'):
+                continue
+            messages[split_name(name)[0]] = os.path.join(sub, name)
+    return messages
+
+def subfolders(path):
+    """Maildir++ subfolders (.Name) of a Maildir."""
+    folders = []
+    for name in os.listdir(path):
+        sub = os.path.join(path, name)
+        if name.startswith('.') and name not in ('.', '..') and is_maildir(sub):
+            folders.append(sub)
+    folders.sort()
+    return folders
+
+class Manifest:
+    """
+    What we've indexed from each Maildir: for each, a dict mapping
+    unique name to (relative path, inode, size, mtime, qterm).
+    """
+    def __init__(self, path):
+        self.db = shelve.open(path)
+
+    def _key(self, maildir):
+        return os.path.abspath(maildir)
+
+    def get(self, maildir):
+        return self.db.get(self._key(maildir), {})
+
+    def set(self, maildir, entries):
+        self.db[self._key(maildir)] = entries
+        self.db.sync()
+
+    def forget(self, maildir):
+        try:
+            del self.db[self._key(maildir)]
+        except KeyError:
+            pass
+
+    def maildirs(self):
+        """The (absolute) paths of all the Maildirs we have manifests for."""
+        return self.db.keys()
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,210 @@
+# Woodpecker index maintenance
+#
+# (c) Copyright James Aylett 2008
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+"""
+Looking after the index. A Xapian database grows and fragments as
+documents are replaced, which we do a lot (every time a message moves,
+or an mbox is read again), and only compacting, which copies it into a
+fresh database, gets the space back. While we're at it we can renumber
+the documents in date order, so that mail from around the same time is
+stored together.
+
+Compacting is done by the xapian-compact tool, since the Python
+bindings don't offer it. After the first time, the index directory is
+a symlink to the current copy (index.1, index.2 and so on), so a new
+copy can be swapped in atomically: anyone opening the index gets
+either the old copy or the new one. (The first time, there's a moment
+with no index there at all.)
+
+We hold the index's write lock throughout, so nothing can be indexed
+into the old copy once we've started copying it.
+"""
+
+import os, shutil
+import xapian
+import woodpecker
+
+# What the terms with each prefix are for; stemmed terms have a Z in
+# front of their prefix
+TERM_PREFIXES = {
+    '': 'words',
+    'A': 'from',
+    'XT': 'to and cc',
+    'S': 'subject',
+    'Q': 'message ids',
+    'D': 'days',
+    'M': 'months',
+    'Y': 'years',
+    'XTHREAD': 'threads',
+    'XFLAG': 'Maildir flags',
+    'XFILENAME': 'filenames',
+}
+_prefixes = TERM_PREFIXES.keys()
+_prefixes.sort(lambda a, b: cmp(len(b), len(a)))
+
+def term_prefix(term):
+    """The prefix of a term, as a key of TERM_PREFIXES with any Z."""
+    stemmed = ''
+    if term.startswith('Z'):
+        stemmed = 'Z'
+        term = term[1:]
+    for prefix in _prefixes:
+        if term.startswith(prefix):
+            return stemmed + prefix
+    return stemmed
+
+def date_order(database):
+    """The docids in database, oldest first (and undated first of all)."""
+    keyed = []
+    for docid in xrange(1, database.get_lastdocid() + 1):
+        try:
+            doc = database.get_document(docid)
+        except xapian.DocNotFoundError:
+            continue
+        # sortable_serialise()d, so these sort as the dates do
+        keyed.append((doc.get_value(woodpecker.VALUE_UTCDATETIME), docid))
+    keyed.sort()
+    return [ docid for (value, docid) in keyed ]
+
+def renumber(database, path):
+    """Copy database to a new one at path, with docids in date order."""
+    out = xapian.WritableDatabase(path, xapian.DB_CREATE)
+    n = 0
+    for docid in date_order(database):
+        out.add_document(database.get_document(docid))
+        n+=1
+        if n % 10000==0:
+            out.flush()
+    out.flush()
+
+def _run_compact(source, dest):
+    import subprocess
+    try:
+        status = subprocess.call(['xapian-compact', source, dest])
+    except OSError, e:
+        raise woodpecker.WoodpeckerError("Couldn't run xapian-compact.", e)
+    if status!=0:
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        raise woodpecker.WoodpeckerError("xapian-compact failed on %s." % source)
+
+def _new_copy(path):
+    """Somewhere next to path for a new copy of the database there."""
+    n = 1
+    while os.path.lexists('%s.%i' % (path, n)):
+        n+=1
+    return '%s.%i' % (path, n)
+
+def swap_in(path, new):
+    """
+    Make path, which everyone opens, the database at new (next to it).
+    Returns the directory that path was, for the caller to remove.
+    """
+    if os.path.islink(path):
+        old = os.path.join(os.path.dirname(path), os.readlink(path))
+        tmp = path + '.swap'
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        os.symlink(os.path.basename(new), tmp)
+        os.rename(tmp, path)
+        return old
+    old = path + '.old'
+    if os.path.exists(old):
+        shutil.rmtree(old)
+    os.rename(path, old)
+    os.symlink(os.path.basename(new), path)
+    return old
+
+def compact_database(path, by_date=False):
+    """
+    Compact the Xapian database at path with xapian-compact, renumbering
+    its documents in date order first if by_date, and swap the result
+    in.
+    """
+    path = path.rstrip(os.sep)
+    lock = xapian.WritableDatabase(path, xapian.DB_OPEN)
+    new = _new_copy(path)
+    if by_date:
+        tmp = new + '.renumbered'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        renumber(xapian.Database(path), tmp)
+        try:
+            _run_compact(tmp, new)
+        finally:
+            shutil.rmtree(tmp)
+    else:
+        _run_compact(path, new)
+    old = swap_in(path, new)
+    # only now can anyone else write to it
+    del lock
+    shutil.rmtree(old)
+
+def table_sizes(path):
+    """{table name: bytes} for the database at path."""
+    path = os.path.realpath(path)
+    sizes = {}
+    for name in os.listdir(path):
+        table = name.split('.')[0]
+        sizes[table] = sizes.get(table, 0) + os.path.getsize(os.path.join(path, name))
+    return sizes
+
+def prefix_counts(database):
+    """{prefix: (distinct terms, postings)}, as term_prefix() sees it."""
+    counts = {}
+    for item in database.allterms():
+        prefix = term_prefix(item.term)
+        (terms, postings) = counts.get(prefix, (0, 0))
+        counts[prefix] = (terms + 1, postings + item.termfreq)
+    return counts
+
+def _describe(prefix):
+    if prefix.startswith('Z'):
+        return 'stemmed ' + TERM_PREFIXES[prefix[1:]]
+    return TERM_PREFIXES[prefix]
+
+def report(path, top=10):
+    """Lines describing the database at path."""
+    database = xapian.Database(path)
+    lines = ["%i documents, average length %.1f terms, last docid %i" % (database.get_doccount(), database.get_avlength(), database.get_lastdocid())]
+    counts = prefix_counts(database)
+    prefixes = counts.keys()
+    prefixes.sort(lambda a, b: cmp(counts[b][0], counts[a][0]) or cmp(a, b))
+    lines.append("%-10s %-20s %10s %12s" % ('prefix', '', 'terms', 'postings'))
+    for prefix in prefixes[:top]:
+        lines.append("%-10s %-20s %10i %12i" % (prefix, _describe(prefix), counts[prefix][0], counts[prefix][1]))
+    sizes = table_sizes(path)
+    tables = sizes.keys()
+    tables.sort()
+    lines.append("%-10s %10s" % ('table', 'MB'))
+    for table in tables:
+        lines.append("%-10s %10.1f" % (table, sizes[table] / 1048576.0))
+    lines.append("%-10s %10.1f" % ('total', sum(sizes.values()) / 1048576.0))
+    return lines
+
+def maintain(path, by_date=False):
+    """
+    Compact the database at path, and return report() lines for it,
+    with its size beforehand.
+    """
+    before = sum(table_sizes(path).values())
+    compact_database(path, by_date)
+    lines = report(path)
+    lines.append("%-10s %10.1f" % ('before', before / 1048576.0))
+    return lines
@@ -0,0 +1,369 @@
+# Woodpecker searching
+#
+# (c) Copyright James Aylett 2008
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+"""
+Searching the index, whatever is going to show the results: the
+curses interface in query.py and the query server both go through a
+Searcher, which holds the database, QueryParser and Enquire open so
+they can be reused from one query to the next.
+"""
+
+import datetime, re, xapian
+import woodpecker, woodpecker.Data, woodpecker.Utils
+
+# Ways of ordering results
+SORT_RELEVANCE = 'relevance'
+SORT_DATE = 'date' # newest first
+SORT_RECENT = 'recent' # relevance, with a boost for recent mail
+SORTS = (SORT_RELEVANCE, SORT_DATE, SORT_RECENT)
+
+# With SORT_RECENT, a message from today gets this much extra weight
+# (about what one good term match is worth), halving for every
+# RECENCY_HALF_LIFE days older it is; after RECENCY_DAYS, nothing
+RECENCY_WEIGHT = 2.0
+RECENCY_HALF_LIFE = 90
+RECENCY_DAYS = 4 * 365
+
+# Boolean filters, and the term prefix each one is a filter on
+FILTER_PREFIXES = {
+    'thread': 'XTHREAD',
+    'flag': 'XFLAG',
+}
+DATE_FILTERS = ('date', 'after', 'before')
+
+# What row() can tell you about a match
+ROW_FIELDS = ('docid', 'rank', 'percent', 'date', 'from', 'to', 'mine',
+              'subject', 'thread', 'more', 'sample', 'filename')
+DEFAULT_ROW_FIELDS = ('docid', 'rank', 'date', 'from', 'to', 'mine',
+                      'subject', 'thread', 'more')
+
+_date_re = re.compile(r'\b(date|after|before):([0-9][0-9-]*)?(\.\.([0-9][0-9-]*)?)?')
+
+def _date_bounds(d):
+    """
+    Turn a YYYY, YYYYMM or YYYYMMDD date (dashes optional) into the
+    first and last YYYYMMDD values it covers, or None if it isn't one.
+    """
+    d = d.replace('-', '')
+    if len(d)==4:
+        return (d + '0101', d + '1231')
+    elif len(d)==6:
+        return (d + '01', d + '31')
+    elif len(d)==8:
+        return (d, d)
+    return None
+
+def _day_before(d):
+    day = datetime.date(int(d[0:4]), int(d[4:6]), int(d[6:8])) - datetime.timedelta(1)
+    return day.strftime('%Y%m%d')
+
+def date_range(kind, start, end=None, has_range=False):
+    """
+    The (first, last) YYYYMMDD values matched by a date, after or
+    before restriction; see expand_dates(). Raises ValueError if the
+    dates aren't ones we understand.
+    """
+    lo = '00000000'
+    hi = '99999999'
+    try:
+        if kind=='date' and has_range:
+            if start:
+                lo = _date_bounds(start)[0]
+            if end:
+                hi = _date_bounds(end)[1]
+        elif start==None or has_range:
+            raise ValueError("Can't use a range with %s:" % kind)
+        elif kind=='date':
+            (lo, hi) = _date_bounds(start)
+        elif kind=='after':
+            lo = _date_bounds(start)[0]
+        else:
+            hi = _day_before(_date_bounds(start)[0])
+    except TypeError:
+        raise ValueError("Not a date: %s" % start)
+    return (lo, hi)
+
+def expand_dates(query_string):
+    """
+    Rewrite the date restrictions we understand into the single range
+    syntax the QueryParser knows about, date:YYYYMMDD..YYYYMMDD, which
+    is matched against VALUE_UTCDATE:
+
+      date:D          on the day, month or year D
+      date:D1..D2     from D1 to D2 inclusive (either can be left off)
+      after:D         on or after D
+      before:D        before D
+
+    Dates are YYYY, YYYYMM or YYYYMMDD, optionally with dashes.
+    """
+    def replace(m):
+        (kind, start, has_range, end) = m.groups()
+        try:
+            return 'date:%s..%s' % date_range(kind, start, end, has_range!=None)
+        except ValueError:
+            # not a date we understand; leave it to the QueryParser
+            return m.group(0)
+    return _date_re.sub(replace, query_string)
+
+def correspondents(doc, data, my_addresses):
+    """
+    (from name, to name, whether it's from us) for a document, using
+    what we worked out at index time if we can. data should have the
+    FromName, ToName and Mine fields, if the document has them.
+    """
+    if not data.has_key('FromName'):
+        # indexed before we stored display names
+        data = woodpecker.Data.decode(doc.get_data(), ('From', 'To'))
+        (from_name, from_address) = woodpecker.Utils.display_address(data.get('From', ''))
+        to_name = woodpecker.Utils.display_address(data.get('To', ''))[0]
+        # ignoring case, as the indexer does
+        mine = from_address.lower() in [ adr.lower() for adr in my_addresses ]
+        return (from_name, to_name, mine)
+    return (data['FromName'], data.get('ToName', ''), bool(data.get('Mine')))
+
+def jsonable(row):
+    """
+    A row with its strings made into unicode, ready for JSON. Strings in
+    document data aren't necessarily UTF-8, so anything that isn't gets
+    replacement characters.
+    """
+    out = []
+    for value in row:
+        if type(value) is str:
+            value = unicode(value, 'utf-8', 'replace')
+        out.append(value)
+    return out
+
+class Searcher:
+    """
+    Runs queries against the index. Nothing here is safe to share
+    between threads; callers that have several must take turns.
+    """
+    def __init__(self, conf, shards=None):
+        self.conf = conf
+        self.my_addresses = conf.my_addresses
+        self.database = conf.get_index(shards)
+        self.enquire = xapian.Enquire(self.database)
+        self.qp = xapian.QueryParser()
+        self.qp.add_prefix('author', 'A')
+        self.qp.add_prefix('from', 'A')
+        self.qp.add_prefix('to', 'XT')
+        self.qp.add_prefix('subject', 'S')
+        self.qp.add_prefix('title', 'S')
+        # keep a reference, or it'll go away under the QueryParser's feet
+        self.date_range = xapian.StringValueRangeProcessor(woodpecker.VALUE_UTCDATE, 'date:')
+        self.qp.add_valuerangeprocessor(self.date_range)
+        for (name, prefix) in FILTER_PREFIXES.items():
+            self.qp.add_boolean_prefix(name, prefix)
+        self.stemmer = xapian.Stem(conf.get_language())
+        self.qp.set_stemmer(self.stemmer)
+        self.qp.set_database(self.database)
+        self.qp.set_stemming_strategy(xapian.QueryParser.STEM_SOME)
+        self.query = xapian.Query()
+        # keep references to these, or they'll go away under the
+        # Enquire's feet; see _recency_source()
+        self.recency = self.old_recency = None
+        self.recency_day = None
+        self.sort = None
+        self.set_sort(SORT_RELEVANCE)
+        self.collapse = None
+        self.set_collapse(False)
+
+    def reopen(self):
+        """
+        Catch up with whatever the indexer has committed since we last
+        looked. Cheap if nothing has changed. (New shards won't appear
+        until we're started again.)
+        """
+        self.database.reopen()
+
+    def revision(self):
+        try:
+            return self.database.get_revision()
+        except (AttributeError, xapian.Error):
+            # older Xapian, or several shards at once; this will do to
+            # spot most changes
+            return (self.database.get_doccount(), self.database.get_lastdocid())
+
+    def parse(self, query_string, filters=None):
+        """
+        Turn what someone typed into a xapian.Query, restricted by
+        filters if given: a dict mapping a name in FILTER_PREFIXES to a
+        value (or list of values, any of which will do), or one of
+        DATE_FILTERS to a date as in expand_dates() (a 'date' filter
+        can also be a D1..D2 range).
+        """
+        query = self.qp.parse_query(expand_dates(query_string))
+        if filters:
+            names = filters.keys()
+            names.sort()
+            for name in names:
+                f = self._filter(name, filters[name])
+                if query.empty():
+                    query = f
+                else:
+                    query = xapian.Query(xapian.Query.OP_FILTER, query, f)
+        return query
+
+    def _filter(self, name, value):
+        if name in DATE_FILTERS:
+            value = str(value)
+            if name=='date' and '..' in value:
+                (start, end) = value.split('..', 1)
+                (lo, hi) = date_range(name, start, end, True)
+            else:
+                (lo, hi) = date_range(name, value)
+            return xapian.Query(xapian.Query.OP_VALUE_RANGE, woodpecker.VALUE_UTCDATE, lo, hi)
+        if not FILTER_PREFIXES.has_key(name):
+            raise ValueError("Unknown filter '%s'." % name)
+        if type(value) not in (list, tuple):
+            value = [value]
+        terms = []
+        for v in value:
+            if type(v) is unicode:
+                v = v.encode('utf-8')
+            terms.append(xapian.Query(FILTER_PREFIXES[name] + str(v)))
+        return xapian.Query(xapian.Query.OP_OR, terms)
+
+    def set_query(self, query):
+        self.query = query
+        self._apply_query()
+
+    def _recency_source(self):
+        """
+        A posting source giving each message the SORT_RECENT boost for
+        its VALUE_UTCDATE. It's a table of days counting back from
+        today, so we make a new one when the day changes.
+        """
+        today = datetime.datetime.utcnow().date()
+        if self.recency_day!=today:
+            # the Enquire may be using yesterday's until we set a query
+            self.old_recency = self.recency
+            self.recency = xapian.ValueMapPostingSource(woodpecker.VALUE_UTCDATE)
+            for age in xrange(RECENCY_DAYS):
+                day = today - datetime.timedelta(age)
+                self.recency.add_mapping(day.strftime('%Y%m%d'), RECENCY_WEIGHT * 0.5 ** (float(age) / RECENCY_HALF_LIFE))
+            self.recency.set_default_weight(0)
+            self.recency_day = today
+        return self.recency
+
+    def _apply_query(self):
+        query = self.query
+        if self.sort==SORT_RECENT and not query.empty():
+            # the boost only adds weight; it doesn't change what matches
+            query = xapian.Query(xapian.Query.OP_AND_MAYBE, query, xapian.Query(self._recency_source()))
+        self.enquire.set_query(query)
+
+    def set_sort(self, sort):
+        if self.sort==sort:
+            return
+        if sort==SORT_DATE:
+            self.enquire.set_sort_by_value_then_relevance(woodpecker.VALUE_UTCDATETIME, True)
+        elif sort==SORT_RECENT:
+            # the boost does most of the work; this just breaks ties
+            self.enquire.set_sort_by_relevance_then_value(woodpecker.VALUE_UTCDATETIME, True)
+        elif sort==SORT_RELEVANCE:
+            self.enquire.set_sort_by_relevance()
+        else:
+            raise ValueError("Unknown sort order '%s'." % sort)
+        recency = SORT_RECENT in (self.sort, sort)
+        self.sort = sort
+        if recency:
+            self._apply_query()
+
+    def set_collapse(self, collapse):
+        """Return only the best match from each thread, or not."""
+        if self.collapse==collapse:
+            return
+        if collapse:
+            self.enquire.set_collapse_key(woodpecker.VALUE_THREAD)
+        else:
+            self.enquire.set_collapse_key(xapian.BAD_VALUENO)
+        self.collapse = collapse
+
+    def get_mset(self, offset, pagesize):
+        """
+        Run the current query. If the indexer has moved the database
+        on far enough that our view of it has gone, catch up and try
+        again.
+        """
+        try:
+            return self.enquire.get_mset(offset, pagesize)
+        except xapian.DatabaseModifiedError:
+            self.reopen()
+            return self.enquire.get_mset(offset, pagesize)
+
+    def get_mset_until(self, latest, offset, pagesize):
+        """
+        Like get_mset(), but only for matches whose VALUE_UTCDATETIME is
+        no later than latest (so never those without a date). With
+        SORT_DATE, carrying on from where the last page ended like this
+        means Xapian only has to keep offset + pagesize candidates,
+        rather than everything before the page as well.
+        """
+        until = xapian.Query(xapian.Query.OP_VALUE_LE, woodpecker.VALUE_UTCDATETIME, latest)
+        self.enquire.set_query(xapian.Query(xapian.Query.OP_FILTER, self.query, until))
+        try:
+            return self.get_mset(offset, pagesize)
+        finally:
+            self._apply_query()
+
+    def row(self, match, fields=DEFAULT_ROW_FIELDS):
+        """
+        Pull the given ROW_FIELDS out of an MSet item, as a list in the
+        same order. Strings are as stored (names and subjects are UTF-8,
+        samples may not be); dates are seconds since the epoch, or None.
+        """
+        doc = match.document
+        data = woodpecker.Data.decode(doc.get_data(), ('FromName', 'ToName', 'Mine', 'Title', 'Sample', 'Filename'))
+        if 'from' in fields or 'to' in fields or 'mine' in fields:
+            (from_name, to_name, mine) = correspondents(doc, data, self.my_addresses)
+        row = []
+        for field in fields:
+            if field=='docid':
+                row.append(match.docid)
+            elif field=='rank':
+                row.append(match.rank)
+            elif field=='percent':
+                row.append(match.percent)
+            elif field=='date':
+                value = doc.get_value(woodpecker.VALUE_UTCDATETIME)
+                if value=='':
+                    row.append(None)
+                else:
+                    row.append(int(xapian.sortable_unserialise(value)))
+            elif field=='from':
+                row.append(from_name)
+            elif field=='to':
+                row.append(to_name)
+            elif field=='mine':
+                row.append(mine)
+            elif field=='subject':
+                row.append(woodpecker.Utils.decode_header_text(data.get('Title', '')))
+            elif field=='thread':
+                row.append(doc.get_value(woodpecker.VALUE_THREAD))
+            elif field=='more':
+                row.append(match.collapse_count)
+            elif field=='sample':
+                row.append(data.get('Sample', ''))
+            elif field=='filename':
+                row.append(data.get('Filename', ''))
+            else:
+                raise ValueError("Unknown field '%s'." % field)
+        return row
@@ -0,0 +1,236 @@
+# Woodpecker query server
+#
+# (c) Copyright James Aylett 2008
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+"""
+A long-running query server, so that things making lots of small
+queries (mail clients, web interfaces) don't pay for opening the
+database each time.
+
+It listens either on a Unix socket (by default, 'socket' in the
+config directory), taking one JSON request per line and answering
+each with one line of JSON, or over HTTP on localhost, taking a JSON
+request as the body of a POST. A request looks like:
+
+  {"query": "from:james after:2008", "offset": 0, "pagesize": 10,
+   "sort": "date", "collapse": false,
+   "filters": {"flag": "S", "date": "200801..200803"},
+   "fields": ["docid", "date", "from", "subject"]}
+
+where everything but query is optional (see Search.Searcher.parse()
+for filters and Search.ROW_FIELDS for fields). The answer is
+
+  {"estimated": 42, "offset": 0, "fields": [...], "rows": [[...], ...]}
+
+with one list per match, in the order given by fields; or, if
+something went wrong, {"error": "what"}.
+
+Before each query we reopen the database, so we see whatever the
+indexer has committed, which costs next to nothing if it hasn't.
+"""
+
+import BaseHTTPServer, getopt, os, SocketServer, sys, threading, xapian
+import woodpecker, woodpecker.Search, woodpecker.Utils
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+class QueryServer:
+    """Answers requests, one at a time, from a single warm Searcher."""
+    MAX_PAGESIZE = 1000
+
+    def __init__(self, conf, verbose=False):
+        self.searcher = woodpecker.Search.Searcher(conf)
+        self.lock = threading.Lock()
+        self.logger = woodpecker.Utils.Logger(verbose)
+
+    def respond(self, text):
+        """
+        Answer a request given as JSON text. Returns (whether it
+        worked, JSON text of the response).
+        """
+        try:
+            request = json.loads(text)
+            if type(request) is not dict:
+                raise ValueError("Request must be a JSON object.")
+            response = self.handle(request)
+            ok = True
+        except (ValueError, TypeError), e:
+            response = {'error': str(e)}
+            ok = False
+        except xapian.Error, e:
+            response = {'error': str(e)}
+            ok = False
+        return (ok, json.dumps(response, separators=(',', ':')))
+
+    def handle(self, request):
+        query_string = request.get('query', u'')
+        if type(query_string) is unicode:
+            query_string = query_string.encode('utf-8')
+        offset = int(request.get('offset', 0))
+        pagesize = int(request.get('pagesize', 10))
+        if offset < 0 or pagesize < 0 or pagesize > QueryServer.MAX_PAGESIZE:
+            raise ValueError("Bad offset or pagesize.")
+        sort = request.get('sort', woodpecker.Search.SORT_RELEVANCE)
+        fields = request.get('fields', woodpecker.Search.DEFAULT_ROW_FIELDS)
+        for field in fields:
+            if field not in woodpecker.Search.ROW_FIELDS:
+                raise ValueError("Unknown field '%s'." % field)
+        fields = [ str(field) for field in fields ]
+        filters = request.get('filters')
+        if filters!=None and type(filters) is not dict:
+            raise ValueError("filters must be a JSON object.")
+
+        self.lock.acquire()
+        try:
+            searcher = self.searcher
+            searcher.reopen()
+            searcher.set_query(searcher.parse(query_string, filters))
+            searcher.set_sort(sort)
+            searcher.set_collapse(bool(request.get('collapse', False)))
+            mset = searcher.get_mset(offset, pagesize)
+            rows = []
+            for m in mset:
+                rows.append(woodpecker.Search.jsonable(searcher.row(m, fields)))
+            estimated = mset.get_matches_estimated()
+        finally:
+            self.lock.release()
+        self.logger.log("'%s' at %i: %i rows of about %i\n", query_string, offset, len(rows), estimated)
+        return {'estimated': estimated, 'offset': offset, 'fields': fields, 'rows': rows}
+
+class _SocketHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        # keep answering until the client hangs up
+        while True:
+            line = self.rfile.readline()
+            if line=='':
+                break
+            if line.strip()=='':
+                continue
+            self.wfile.write(self.server.query_server.respond(line)[1] + '\n')
+            self.wfile.flush()
+
+class _HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('content-length', 0))
+        except ValueError:
+            length = 0
+        (ok, body) = self.server.query_server.respond(self.rfile.read(length))
+        if ok:
+            self.send_response(200)
+        else:
+            self.send_response(400)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        self.server.query_server.logger.log(format + '\n', *args)
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def serve_socket(query_server, path):
+    if os.path.exists(path):
+        # left behind by a server that didn't get to clean up
+        os.unlink(path)
+    # mail is private
+    umask = os.umask(077)
+    try:
+        server = _UnixServer(path, _SocketHandler)
+    finally:
+        os.umask(umask)
+    server.query_server = query_server
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+def serve_http(query_server, port):
+    server = _HTTPServer(('127.0.0.1', port), _HTTPHandler)
+    server.query_server = query_server
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def usage():
+    print u"Usage: %s [options]" % sys.argv[0]
+    print u"Options:"
+    print u"\t--help\t\tThis message"
+    print u"\t--confdir d\tUse ``d'' instead of ~/.woodpecker"
+    print u"\t--verbose\tLog each query"
+    print u"\t--socket p\tListen on Unix socket p (default: socket in confdir)"
+    print u"\t--port n\tListen for HTTP on localhost port n instead"
+
+def main():
+    try:
+        try:
+            optlist, args = getopt.getopt(sys.argv[1:], 'hc:vs:p:', ['help', 'confdir=', 'verbose', 'socket=', 'port='])
+        except getopt.GetoptError:
+            usage()
+            sys.exit(2)
+
+        confdir = None
+        verbose = False
+        socket_path = None
+        port = None
+
+        for opt, arg in optlist:
+            if opt in ('-h', '--help'):
+                usage()
+                sys.exit()
+            if opt in ('-c', '--confdir'):
+                confdir = arg
+            if opt in ('-v', '--verbose'):
+                verbose = True
+            if opt in ('-s', '--socket'):
+                socket_path = arg
+            if opt in ('-p', '--port'):
+                try:
+                    port = int(arg)
+                except ValueError:
+                    usage()
+                    sys.exit(2)
+
+        conf = woodpecker.Config(confdir)
+        query_server = QueryServer(conf, verbose)
+        try:
+            if port!=None:
+                query_server.logger.log("Listening on http://127.0.0.1:%i/\n", port)
+                serve_http(query_server, port)
+            else:
+                if socket_path==None:
+                    socket_path = conf.socketpath
+                query_server.logger.log("Listening on %s\n", socket_path)
+                serve_socket(query_server, socket_path)
+        except KeyboardInterrupt:
+            pass
+    except woodpecker.WoodpeckerError, e:
+        sys.stdout.write(str(e))
+        sys.stdout.write("\n")
+        print e.aux
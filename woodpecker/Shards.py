@@ -0,0 +1,269 @@
+# Woodpecker sharded indexes
+#
+# (c) Copyright James Aylett 2008
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+"""
+Splitting the index into shards, so that parts of it can be built (or
+rebuilt) separately, several at once, and so that old parts can be
+compacted and left alone.
+
+Put one of these in the 'sharding' config file to turn it on:
+
+  year     each message goes in the shard for the year (UTC) it was
+           sent, or 'undated'
+  mailbox  each mbox or Maildir goes in the shard for the first group
+           in the 'shard-groups' config file that it's in, or 'other'. Each
+           line of that is a shard name then the paths in that group:
+
+             work ~/Mail/work ~/Mail/clients
+             lists ~/Mail/lists
+
+Each shard lives in shards/<name> in the config directory, with its
+own database and its own checkpoints, Maildir manifests and thread
+map, so nothing is shared between processes building different
+shards. Searching opens them all as one (Config.get_index()).
+
+Building a shard means going through all the mail we're given and
+indexing just what belongs in it. For year shards that means reading
+the headers of every new message in every shard's build (and once
+beforehand, to see if it needs a new shard), which costs a lot less
+than indexing them but isn't free.
+
+A shard that won't change again (last year's, say) can be frozen:
+compacted with xapian-compact, and marked so that nothing writes to it
+again until it's thawed.
+"""
+
+import email.Utils, os, time
+import woodpecker, woodpecker.Maildir, woodpecker.Maintenance, woodpecker.MBox
+import woodpecker.Stats, woodpecker.Utils
+
+YEAR = 'year'
+MAILBOX = 'mailbox'
+SCHEMES = (YEAR, MAILBOX)
+
+UNDATED = 'undated'
+OTHER = 'other'
+
+FROZEN = 'frozen' # marker file in a frozen shard's directory
+
+def year_of(headers):
+    """The year shard for a message with the given headers."""
+    try:
+        utcdate = email.Utils.mktime_tz(email.Utils.parsedate_tz(headers.get('date')))
+        return '%04i' % time.gmtime(utcdate)[0]
+    except (TypeError, ValueError, OverflowError):
+        return UNDATED
+
+class Scheme:
+    """How messages are divided between shards."""
+    def __init__(self, config):
+        self.config = config
+        self.kind = config.sharding
+        if self.kind not in SCHEMES:
+            raise woodpecker.WoodpeckerError("Unknown sharding '%s'." % self.kind, "Choose from: %s" % ', '.join(SCHEMES))
+        self.groups = []
+        for line in config.shard_groups:
+            words = line.split()
+            if words[0].startswith('#'):
+                continue
+            prefixes = [ os.path.abspath(os.path.expanduser(p)) for p in words[1:] ]
+            self.groups.append((words[0], prefixes))
+
+    def group_for(self, path):
+        path = os.path.abspath(path)
+        for (name, prefixes) in self.groups:
+            for prefix in prefixes:
+                if path==prefix or path.startswith(prefix.rstrip(os.sep) + os.sep):
+                    return name
+        return OTHER
+
+    def may_contain(self, shard, path):
+        """Could anything in the mbox or Maildir at path be in shard?"""
+        if self.kind==MAILBOX:
+            return self.group_for(path)==shard
+        return True
+
+    def shard_for(self, path, buf):
+        """The shard for a raw message found in mailbox path."""
+        if self.kind==MAILBOX:
+            return self.group_for(path)
+        return year_of(woodpecker.Utils.message_headers(buf))
+
+    def shards_for(self, paths, full=False):
+        """
+        The names of all the shards to build for the mail under paths:
+        the ones we already have, and any that mail we haven't seen
+        before needs. Unless full, that's only what's past where all the
+        unfrozen shards have got to (mbox checkpoints and Maildir
+        manifests), so we don't read every message's date every time.
+        """
+        existing = self.config.get_shards()
+        names = {}
+        for name in existing:
+            names[name] = True
+        if self.kind==MAILBOX:
+            for (kind, path) in mailboxes(paths):
+                names[self.group_for(path)] = True
+        else:
+            seen = []
+            if not full:
+                seen = [ os.path.join(self.config.get_shard_dir(name), '') for name in existing if not is_frozen(self.config, name) ]
+            checkpoints = [ woodpecker.Utils.Checkpoints(path + 'checkpoints') for path in seen ]
+            manifests = [ woodpecker.Maildir.Manifest(path + 'maildirs') for path in seen ]
+            try:
+                for (kind, path) in mailboxes(paths):
+                    if kind=='mbox':
+                        self._mbox_shards(path, _resume_point(checkpoints, path), names)
+                    else:
+                        self._maildir_shards(path, manifests, names)
+            finally:
+                for db in checkpoints + manifests:
+                    db.close()
+        names = names.keys()
+        names.sort()
+        return names
+
+    def _mbox_shards(self, path, start, names):
+        fp = file(path)
+        scanner = woodpecker.MBox.MBoxScanner(fp, start)
+        try:
+            for (offset, length, buf) in scanner:
+                names[self.shard_for(path, buf)] = True
+        finally:
+            scanner.close()
+            fp.close()
+
+    def _maildir_shards(self, path, manifests, names):
+        known = [ manifest.get(path) for manifest in manifests ]
+        for (unique, relpath) in woodpecker.Maildir.list_maildir(path).items():
+            unseen = [ k for k in known if not k.has_key(unique) ]
+            if known and not unseen:
+                # every shard has seen it already
+                continue
+            fp = file(os.path.join(path, relpath), 'rb')
+            try:
+                # enough for the headers, nearly always
+                buf = fp.read(65536)
+            finally:
+                fp.close()
+            names[self.shard_for(path, buf)] = True
+
+def _resume_point(checkpoints, mbox):
+    """
+    The offset in mbox that all of checkpoints (Utils.Checkpoints) have
+    got past, or 0 if any of them hasn't seen it, or has seen it
+    rewritten since.
+    """
+    start = None
+    for one in checkpoints:
+        point = one.get(mbox)
+        if point==None or not one.is_valid(mbox, point):
+            return 0
+        if start==None or point['offset'] < start:
+            start = point['offset']
+    return start or 0
+
+def mailboxes(paths):
+    """
+    Yield ('mbox', path) or ('maildir', path) for every mailbox under
+    paths, looking in directories as Pecker.index_mailbox() does.
+    """
+    if type(paths) is not list:
+        paths = [paths]
+    for path in paths:
+        if os.path.isdir(path):
+            if woodpecker.Maildir.is_maildir(path):
+                yield ('maildir', path)
+                for (kind, sub) in mailboxes(woodpecker.Maildir.subfolders(path)):
+                    yield (kind, sub)
+            else:
+                names = os.listdir(path)
+                names.sort()
+                subpaths = [ os.path.join(path, name) for name in names if not name.startswith('.') ]
+                for (kind, sub) in mailboxes(subpaths):
+                    yield (kind, sub)
+        elif os.path.isfile(path):
+            yield ('mbox', path)
+
+def is_frozen(config, shard):
+    return os.path.exists(os.path.join(config.get_shard_dir(shard), FROZEN))
+
+def _build_shard(args):
+    (config, shard, paths, verbose, full, policy, jobs) = args
+    import woodpecker.Indexer
+    if jobs > 1:
+        pecker = woodpecker.Indexer.ParallelPecker(config, verbose, full, policy, jobs, shard)
+    else:
+        pecker = woodpecker.Indexer.Pecker(config, verbose, full, policy, shard)
+    # build() writes the stats for all the shards together
+    pecker.statspath = None
+    try:
+        pecker.index_mailbox(paths)
+    finally:
+        pecker.close()
+    return pecker.stats.take()
+
+def build(config, paths, verbose=True, full=False, policy=None, jobs=1):
+    """
+    Bring every (unfrozen) shard that the mail under paths needs up to
+    date, jobs at a time. Returns the combined Stats. With only one
+    shard to build, its jobs work on messages instead.
+    """
+    stats = woodpecker.Stats.Stats()
+    scheme = Scheme(config)
+    logger = woodpecker.Utils.Logger(verbose)
+    names = []
+    for name in scheme.shards_for(paths, full):
+        if is_frozen(config, name):
+            logger.log("Shard %s is frozen; leaving it alone.\n", name)
+        else:
+            names.append(name)
+    if jobs > 1 and len(names) > 1:
+        # pool processes can't have pools of their own
+        work = [ (config, name, paths, verbose, full, policy, 1) for name in names ]
+        import multiprocessing
+        pool = multiprocessing.Pool(min(jobs, len(work)))
+        try:
+            results = pool.map(_build_shard, work, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        work = [ (config, name, paths, verbose, full, policy, jobs) for name in names ]
+        results = map(_build_shard, work)
+    for taken in results:
+        stats.merge(taken)
+    return stats
+
+def compact(config, shard):
+    """Compact a shard's database; see Maintenance."""
+    if not os.path.isdir(config.get_shard_dir(shard)):
+        raise woodpecker.WoodpeckerError("There's no shard called %s." % shard)
+    woodpecker.Maintenance.compact_database(os.path.join(config.get_shard_dir(shard), 'index'))
+
+def freeze(config, shard):
+    """Compact a shard, and mark it so that nothing writes to it again."""
+    compact(config, shard)
+    fp = file(os.path.join(config.get_shard_dir(shard), FROZEN), 'w')
+    fp.close()
+
+def thaw(config, shard):
+    path = os.path.join(config.get_shard_dir(shard), FROZEN)
+    if os.path.exists(path):
+        os.unlink(path)
@@ -0,0 +1,154 @@
+# Woodpecker indexing statistics
+#
+# (c) Copyright James Aylett 2008
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+"""
+Where the indexer's time goes. Each stage adds how long it took to a
+Stats object, which also keeps counters (messages, bytes and so on)
+and counts failures by category. All of this is just adding numbers
+to dicts, so it's cheap enough to leave on all the time.
+
+The stages are:
+
+  scan      finding the next message in an mbox
+  check     fingerprinting it and seeing if we have it already
+  parse     parsing it into an email.Message
+  decode    decoding (base64, quoted-printable) the parts we index
+  html      converting HTML parts to text
+  attach    getting text out of attachments (or waiting for it)
+  termgen   generating terms, from headers and text
+  sample    building the sample of the text we store
+  thread    working out its thread
+  replace   handing the document to the database
+  flush     committing to disk
+
+When indexing in parallel, the stages up to sample happen in the
+workers, so their times add up to more than the time that's passed.
+"""
+
+import os, time
+
+STAGES = ('scan', 'check', 'parse', 'decode', 'html', 'attach',
+          'termgen', 'sample', 'thread', 'replace', 'flush')
+
+class Stats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.times = {}
+        self.calls = {}
+        self.counters = {}
+        self.failures = {}
+
+    def add(self, stage, seconds):
+        """Record one go at stage, which took seconds."""
+        self.times[stage] = self.times.get(stage, 0.0) + seconds
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def fail(self, category):
+        self.failures[category] = self.failures.get(category, 0) + 1
+
+    def take(self):
+        """
+        Return what we've recorded (without the clock), and start
+        again; for passing back from worker processes to be merge()d.
+        """
+        taken = (self.times, self.calls, self.counters, self.failures)
+        self.reset()
+        return taken
+
+    def merge(self, taken):
+        (times, calls, counters, failures) = taken
+        for (stage, seconds) in times.items():
+            self.times[stage] = self.times.get(stage, 0.0) + seconds
+        for (stage, n) in calls.items():
+            self.calls[stage] = self.calls.get(stage, 0) + n
+        for (name, n) in counters.items():
+            self.count(name, n)
+        for (category, n) in failures.items():
+            self.failures[category] = self.failures.get(category, 0) + n
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def as_dict(self):
+        stages = {}
+        for stage in self.times.keys():
+            stages[stage] = {'seconds': self.times[stage], 'calls': self.calls[stage]}
+        return {'elapsed': self.elapsed(),
+                'stages': stages,
+                'counters': self.counters,
+                'failures': self.failures}
+
+    def progress(self):
+        """A one-line summary of how we're getting on."""
+        elapsed = self.elapsed()
+        messages = self.counters.get('messages', 0)
+        rate = 0
+        if elapsed > 0:
+            rate = messages / elapsed
+        return "%i messages indexed (%.1f MB), %i unchanged, %i failures; %.1f messages/s" % (messages, self.counters.get('bytes', 0) / 1048576.0, self.counters.get('unchanged', 0), sum(self.failures.values()), rate)
+
+    def report(self):
+        """A table of where the time went, and what failed."""
+        elapsed = self.elapsed()
+        lines = [self.progress(), "%-10s %10s %6s %10s %12s" % ('stage', 'seconds', '%', 'calls', 'us/call')]
+        stages = list(STAGES)
+        for stage in self.times.keys():
+            if stage not in stages:
+                stages.append(stage)
+        for stage in stages:
+            if not self.times.has_key(stage):
+                continue
+            seconds = self.times[stage]
+            share = 0
+            if elapsed > 0:
+                share = seconds * 100 / elapsed
+            lines.append("%-10s %10.2f %6.1f %10i %12.1f" % (stage, seconds, share, self.calls[stage], seconds * 1e6 / self.calls[stage]))
+        lines.append("%-10s %10.2f" % ('elapsed', elapsed))
+        if self.counters:
+            names = self.counters.keys()
+            names.sort()
+            lines.append(', '.join([ '%s %i' % (name, self.counters[name]) for name in names ]))
+        if self.failures:
+            lines.append("failures:")
+            categories = self.failures.keys()
+            categories.sort()
+            for category in categories:
+                lines.append("  %-40s %i" % (category, self.failures[category]))
+        return lines
+
+    def write(self, path):
+        """Write as_dict() to path as JSON, replacing it atomically."""
+        try:
+            import json
+        except ImportError:
+            import simplejson as json
+        tmp = path + '.tmp'
+        fp = file(tmp, 'w')
+        try:
+            json.dump(self.as_dict(), fp, indent=2, sort_keys=True)
+            fp.write('\n')
+        finally:
+            fp.close()
+        os.rename(tmp, path)
@@ -0,0 +1,107 @@
+# Woodpecker threading
+#
+# (c) Copyright James Aylett 2008
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+"""
+Working out which thread each message belongs to.
+
+A thread is named after (a hash of) its root message-id. We keep a
+persistent map from every message-id we've seen, whether on a message
+or in someone's References, to its thread, so replies get put in the
+right thread whatever order we index things in. Replies with no
+References or In-Reply-To fall back to matching on subject.
+"""
+
+import md5, re, shelve
+
+_msgid_re = re.compile(r'<([^<>]+)>')
+_reply_re = re.compile(r'^\s*((re|fwd?|aw|sv)(\[\d+\])?:\s*|\[[^\]]*\]\s*)+', re.I)
+
+def thread_headers(mess):
+    """
+    Pull out what we need to thread a message: (message-id, list of
+    referenced message-ids, root first, and the subject).
+    """
+    mid = mess.get("message-id")
+    if mid!=None:
+        mid = mid.strip().strip("<>")
+    refs = _msgid_re.findall(mess.get("references", ""))
+    for parent in _msgid_re.findall(mess.get("in-reply-to", "")):
+        if parent not in refs:
+            refs.append(parent)
+    return (mid, refs, mess.get("subject", ""))
+
+def normalise_subject(subject):
+    """
+    Strip reply and forward markers and list tags, and squash case and
+    whitespace. Returns (normalised subject, whether it looked like a
+    reply).
+    """
+    m = _reply_re.match(subject)
+    if m!=None:
+        subject = subject[m.end():]
+    return (' '.join(subject.lower().split()), m!=None)
+
+def thread_id(root):
+    return md5.new(root).hexdigest()[:16]
+
+class ThreadMap:
+    """Persistent message-id to thread id map."""
+    SUBJECT = '\0subject:' # keys for the subject fallback
+
+    def __init__(self, path):
+        self.db = shelve.open(path)
+
+    def thread_for(self, mid, refs, subject):
+        """
+        Find (or start) the thread for a message, and remember it for
+        the message and everything it refers to.
+        """
+        thread = None
+        ids = refs[:]
+        if mid!=None:
+            ids.insert(0, mid)
+        for i in ids:
+            thread = self.db.get(i)
+            if thread!=None:
+                break
+        (subject, is_reply) = normalise_subject(subject)
+        skey = self.SUBJECT + subject
+        if thread==None:
+            if refs:
+                thread = thread_id(refs[0])
+            elif is_reply and subject!='' and self.db.has_key(skey):
+                thread = self.db[skey]
+            elif mid!=None:
+                thread = thread_id(mid)
+            else:
+                thread = thread_id(subject)
+        for i in ids:
+            if not self.db.has_key(i):
+                self.db[i] = thread
+        # replies with no references most likely belong to the latest
+        # thread started with their subject
+        if subject!='' and (not is_reply or not self.db.has_key(skey)):
+            self.db[skey] = thread
+        return thread
+
+    def sync(self):
+        self.db.sync()
+
+    def close(self):
+        self.db.close()
@@ -17,7 +17,8 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301
 # USA
 
-import email, email.Errors, os, sys, time
+import woodpecker
+import email, email.Errors, email.FeedParser, email.Header, email.Parser, email.Utils, md5, os, re, shelve, sys, tempfile, time
 
 # Originally taken from standard mailbox; note that the standard
 # Python license is GPL-compatible.
@@ -96,10 +97,253 @@ def msgfactory(fp):
         # Similarly (happens on HUGE emails)
         return ''
 
+def msgfactory_buffer(buf):
+    """
+    As msgfactory, but parsing from a string or buffer. Running out of
+    memory isn't hidden here: that's something the caller should hear
+    about (and BodyFilter should stop it happening).
+    """
+    try:
+        return email.message_from_string(str(buf))
+    except email.Errors.MessageParseError:
+        return ''
+
+def msgfactory_filtered(buf, body_filter):
+    """
+    As msgfactory_buffer, but passing the message through body_filter
+    (a BodyFilter) on its way into the parser, so we never hold more
+    of it than the filter lets through.
+    """
+    parser = email.FeedParser.FeedParser()
+    try:
+        pending = []
+        size = 0
+        for line in body_filter.lines(buf):
+            pending.append(line)
+            size += len(line)
+            if size >= BodyFilter.CHUNK:
+                parser.feed(''.join(pending))
+                pending = []
+                size = 0
+        parser.feed(''.join(pending))
+        return parser.close()
+    except email.Errors.MessageParseError:
+        return ''
+
+def _buffer_lines(buf, chunk):
+    """
+    The lines of a string or buffer, with their line endings, reading
+    chunk bytes at a time. A line longer than chunk comes out in
+    pieces.
+    """
+    pending = ''
+    for start in xrange(0, len(buf), chunk):
+        lines = (pending + buf[start:start + chunk]).splitlines(True)
+        pending = lines.pop()
+        for line in lines:
+            yield line
+        if len(pending) >= chunk:
+            yield pending
+            pending = ''
+    if pending:
+        yield pending
+
+_header_line_re = re.compile(r'(From |[\041-\071\073-\176]+:|[\t ])')
+
+class BodyFilter:
+    """
+    Cuts the bodies of a raw message's parts down to size before it's
+    parsed, so that a huge message doesn't need memory in proportion to
+    its size (several times over, once it's parsed and decoded).
+
+    Headers, and the MIME boundaries that give the message its shape,
+    always get through. The body of each text/plain or text/html part
+    is cut off after part_limit bytes, at the end of a line; any other
+    part keeps its body only if keep(headers) says so and it's no more
+    than attachment_limit bytes. truncated counts the parts we've cut
+    short or dropped.
+    """
+    CHUNK = 65536
+
+    def __init__(self, part_limit, attachment_limit=0, keep=None):
+        self.part_limit = part_limit
+        self.attachment_limit = attachment_limit
+        self.keep = keep
+        self.truncated = 0
+
+    def _start_body(self, headers):
+        """
+        Decide what to let through of the body that follows headers.
+        Returns (limit, held, boundary, nested): held is a list to hold
+        lines in until we know the whole part fits, or None to pass them
+        straight on; boundary is the part's MIME boundary, if it has
+        one; nested is true if the body is another message, starting
+        with its own headers.
+        """
+        part = email.Parser.HeaderParser().parsestr(''.join(headers))
+        ctype = part.get_content_type()
+        if part.get_content_maintype()=='multipart':
+            boundary = part.get_boundary()
+            if boundary!=None:
+                # the preamble
+                return (self.part_limit, None, '--' + boundary, False)
+        if ctype=='message/rfc822':
+            return (self.part_limit, None, None, True)
+        if ctype in ('text/plain', 'text/html'):
+            return (self.part_limit, None, None, False)
+        if self.keep!=None and self.keep(part):
+            return (self.attachment_limit, [], None, False)
+        return (0, None, None, False)
+
+    def lines(self, buf):
+        """Yield the lines of buf (a string or buffer) that we keep."""
+        boundaries = []
+        in_headers = True
+        headers = []
+        # for the body of the current part: how much we allow, how much
+        # we've let through, lines held back, and whether we've cut it
+        limit = size = 0
+        held = None
+        cut = False
+        for line in _buffer_lines(buf, self.CHUNK):
+            if in_headers:
+                if line.strip()!='' and _header_line_re.match(line)!=None:
+                    headers.append(line)
+                    yield line
+                    continue
+                # the end of the headers
+                (limit, held, boundary, nested) = self._start_body(headers)
+                headers = []
+                size = 0
+                cut = False
+                if boundary!=None:
+                    boundaries.append(boundary)
+                if line.strip()=='':
+                    yield line
+                    in_headers = nested
+                    continue
+                # no blank line after the headers, so this is body
+                in_headers = False
+
+            if boundaries and line.startswith('--'):
+                marker = line.rstrip()
+                found = None
+                for i in range(len(boundaries) - 1, -1, -1):
+                    if marker==boundaries[i] or marker==boundaries[i] + '--':
+                        found = i
+                        break
+                if found!=None:
+                    if held!=None:
+                        for l in held:
+                            yield l
+                    held = None
+                    if marker==boundaries[found]:
+                        # on to the next part
+                        del boundaries[found + 1:]
+                        in_headers = True
+                        headers = []
+                    else:
+                        # the end of this multipart; anything up to the
+                        # next boundary is epilogue
+                        del boundaries[found:]
+                        limit = self.part_limit
+                        size = 0
+                        cut = False
+                    yield line
+                    continue
+
+            if size + len(line) <= limit:
+                size += len(line)
+                if held!=None:
+                    held.append(line)
+                else:
+                    yield line
+            else:
+                if not cut:
+                    self.truncated += 1
+                    cut = True
+                # an attachment is all or nothing
+                held = None
+                limit = 0
+        if held!=None:
+            for l in held:
+                yield l
+
+_line_end_re = re.compile(r'\n')
+_header_end_re = re.compile(r'\n\r?\n')
+
+def message_fingerprint(buf):
+    """
+    md5 of a raw message (string or buffer), ignoring any mbox "From "
+    line, which says how the message got here rather than what it is.
+    """
+    start = 0
+    if buf[:5]=='From ':
+        m = _line_end_re.search(buf)
+        if m!=None:
+            start = m.end()
+    return md5.new(buffer(buf, start)).hexdigest()
+
+def message_headers(buf):
+    """Parse just the headers of a raw message, for a cheap look at it."""
+    m = _header_end_re.search(buf)
+    if m==None:
+        end = len(buf)
+    else:
+        end = m.start()
+    return email.Parser.HeaderParser().parsestr(str(buf[:end]))
+
+# the headers that say which message this is, for synthetic_message_id()
+IDENTIFYING_HEADERS = ('from', 'to', 'cc', 'date', 'subject')
+
+def synthetic_message_id(headers, buf):
+    """
+    A Message-ID for a message that doesn't have one, made from the
+    headers that say which message it is (with whitespace and case
+    evened out) and an md5 of its body, so that we make the same one
+    every time we see the same message. headers are as from
+    message_headers(buf).
+    """
+    h = md5.new()
+    for name in IDENTIFYING_HEADERS:
+        value = headers.get(name, '')
+        h.update('%s:%s\n' % (name, ' '.join(value.split()).lower()))
+    m = _header_end_re.search(buf)
+    if m!=None:
+        # where it sits in an mbox can change its trailing newlines
+        end = len(buf)
+        while end > m.end() and buf[end - 1] in '\r\n':
+            end-=1
+        h.update(buffer(buf, m.end(), end - m.end()))
+    return '%s@woodpecker.synthetic' % h.hexdigest()
+
+def decode_header_text(text):
+    """Decode any RFC 2047 encoded words in text, giving UTF-8."""
+    pieces = []
+    try:
+        for (s, charset) in email.Header.decode_header(text):
+            try:
+                pieces.append(unicode(s, charset or 'ascii'))
+            except (UnicodeError, LookupError):
+                pieces.append(unicode(s, 'latin-1'))
+    except email.Errors.HeaderParseError:
+        return text
+    return u' '.join(pieces).encode('utf-8')
+
+def display_address(header):
+    """
+    Split an address header into (what to display, address): the
+    display part is the decoded real name if there is one, otherwise
+    the address itself.
+    """
+    (name, address) = email.Utils.parseaddr(header)
+    if name!='':
+        return (decode_header_text(name), address)
+    return (address, address)
+
 def make_temp_file(string):
-    fname = os.tempnam()
-    os.unlink(fname)
-    fp = file(fname, "wb")
+    (fd, fname) = tempfile.mkstemp()
+    fp = os.fdopen(fd, "wb")
     fp.write(string)
     fp.close()
     return fname
@@ -122,30 +366,273 @@ def stdout_to_string(cmd):
     return out
 
 class Logger:
-    def __init__(self, verbose):
+    """
+    Timestamped progress messages. Any args are formatted into the
+    message only if it's actually going to be shown, so quiet runs
+    don't pay for building strings nobody sees.
+    """
+    def __init__(self, verbose, prefix=''):
         self.verbose = verbose
+        self.prefix = prefix
 
-    def log(self, message, include_timestamp=True):
+    def log(self, message, *args):
         if not self.verbose:
             return
-        if include_timestamp:
-            s = time.strftime('%H:%M:%S ')
-        else:
-            s = ''
-        s += message
-        self._log(message)
+        if args:
+            message = message % args
+        self._log(time.strftime('%H:%M:%S ') + self.prefix + message)
 
     def _log(self, message):
         sys.stderr.write(message)
         sys.stderr.flush()
 
+class LRUCache:
+    """
+    A small least-recently-used cache. Lookups are linear in the size,
+    so keep it small.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = {}
+        self.order = []
+
+    def get(self, key, default=None):
+        if not self.entries.has_key(key):
+            return default
+        self.order.remove(key)
+        self.order.append(key)
+        return self.entries[key]
+
+    def has_key(self, key):
+        return self.entries.has_key(key)
+
+    def put(self, key, value):
+        if self.entries.has_key(key):
+            self.order.remove(key)
+        self.entries[key] = value
+        self.order.append(key)
+        while len(self.order) > self.size:
+            del self.entries[self.order.pop(0)]
+
+    def clear(self):
+        self.entries = {}
+        self.order = []
+
+# Documents have one of these terms for every mailbox their message has
+# been seen in, not just the one their data says it's in, so that if
+# that one loses it we know where else to look
+SOURCE_PREFIX = 'XSOURCE'
+
+def source_term(mailbox):
+    """The term for a mailbox (an mbox or Maildir, by absolute path)."""
+    return SOURCE_PREFIX + md5.new(mailbox).hexdigest()
+
 class MBoxSource:
-    def __init__(self, filename, message_num):
+    def __init__(self, filename, message_num, offset=None, length=None):
         self.filename = filename
+        self.mailbox = filename
         self.message_num = message_num
+        self.offset = offset
+        self.length = length
 
     def add_terms(self, indexer):
         indexer.index_text_without_positions(self.filename, 1, 'XFILENAME')
 
     def get_data(self):
         return { 'Filename': self.filename, 'MessageNum': self.message_num }
+
+    def get_values(self):
+        if self.offset==None:
+            return {}
+        return { woodpecker.VALUE_OFFSET: str(self.offset),
+                 woodpecker.VALUE_LENGTH: str(self.length) }
+
+    def get_terms(self):
+        return [ source_term(self.mailbox) ]
+
+class MaildirSource:
+    def __init__(self, filename):
+        self.filename = filename
+        # the file's in new/ or cur/
+        self.mailbox = os.path.dirname(os.path.dirname(filename))
+        info = os.path.basename(filename).split(':', 1)
+        if len(info)==2 and info[1].startswith('2,'):
+            self.flags = info[1][2:]
+        else:
+            self.flags = ''
+
+    def add_terms(self, indexer):
+        indexer.index_text_without_positions(self.filename, 1, 'XFILENAME')
+
+    def get_data(self):
+        return { 'Filename': self.filename, 'Flags': self.flags }
+
+    def get_values(self):
+        # the whole file is the message
+        return { woodpecker.VALUE_OFFSET: '',
+                 woodpecker.VALUE_LENGTH: '' }
+
+    def get_terms(self):
+        # one boolean term per Maildir flag (S for seen, R for replied...)
+        return [ 'XFLAG' + flag for flag in self.flags ] + [ source_term(self.mailbox) ]
+
+def read_message(filename, offset, length, fingerprint=None):
+    """
+    Read the raw text of a message straight out of its mbox, given
+    where the indexer found it. Raises WoodpeckerError if the mbox has
+    changed so that there's no longer that message there (checked
+    against fingerprint, if we have one).
+    """
+    fp = file(filename, 'rb')
+    try:
+        fp.seek(offset)
+        # and a bit more, to check that the next message starts there
+        raw = fp.read(length + 5)
+    finally:
+        fp.close()
+    following = raw[length:]
+    raw = raw[:length]
+    if len(raw)!=length or not raw.startswith('From ') or following not in ('', 'From '):
+        raise woodpecker.WoodpeckerError("%s has changed since it was indexed." % filename)
+    if fingerprint and message_fingerprint(raw)!=fingerprint:
+        raise woodpecker.WoodpeckerError("%s has changed since it was indexed." % filename)
+    return raw
+
+def get_message(doc, raw=False):
+    """
+    Fetch the full message for an indexed document: the parsed
+    email.Message, or the raw text if raw is true. Raises
+    WoodpeckerError if we can't.
+    """
+    import woodpecker.Data
+    data = woodpecker.Data.decode(doc.get_data(), ('Filename', 'Flags'))
+    offset = doc.get_value(woodpecker.VALUE_OFFSET)
+    length = doc.get_value(woodpecker.VALUE_LENGTH)
+    fingerprint = doc.get_value(woodpecker.VALUE_FINGERPRINT)
+    # only Maildir messages have Flags, even if there aren't any; mbox
+    # messages indexed before we stored offsets have no offset either
+    is_maildir = data.has_key('Flags')
+    if not data.has_key('Filename') or (not is_maildir and (offset=='' or length=='')):
+        raise woodpecker.WoodpeckerError("Don't know where this message is; reindex?")
+    try:
+        if is_maildir:
+            # the file is the message
+            fp = file(data['Filename'], 'rb')
+            try:
+                text = fp.read()
+            finally:
+                fp.close()
+            if fingerprint and message_fingerprint(text)!=fingerprint:
+                raise woodpecker.WoodpeckerError("%s has changed since it was indexed." % data['Filename'])
+        else:
+            text = read_message(data['Filename'], int(offset), int(length), fingerprint)
+    except IOError, e:
+        raise woodpecker.WoodpeckerError("Can't read %s." % data['Filename'], e)
+    if raw:
+        return text
+    return email.message_from_string(text)
+
+def messages_by_number(filename, numbers):
+    """
+    Yield (number, raw text) for each message in the mbox filename
+    whose number (counting from 0) is a key of numbers. For documents
+    indexed before we stored offsets, which only know that, and even
+    then the count can be off; check what you get.
+    """
+    import woodpecker.MBox
+    fp = file(filename, 'rb')
+    scanner = woodpecker.MBox.MBoxScanner(fp)
+    try:
+        num = 0
+        for (offset, length, buf) in scanner:
+            if numbers.has_key(num):
+                yield (num, str(buf))
+            num+=1
+    finally:
+        scanner.close()
+        fp.close()
+
+class Checkpoints:
+    """
+    Remembers how far through each mbox we got last time, so that
+    append-only mboxes can be picked up where we left off rather than
+    re-indexed from the start.
+
+    Each checkpoint records the byte offset we stopped at, the number
+    of messages before it, the size and mtime of the file at that
+    point, and a fingerprint of the bytes leading up to the offset (so
+    we can spot an mbox that's been rewritten rather than appended to).
+    """
+    FINGERPRINT_LENGTH = 4096
+
+    def __init__(self, path):
+        self.db = shelve.open(path)
+
+    def _key(self, mbox):
+        return os.path.abspath(mbox)
+
+    def get(self, mbox):
+        """Get the checkpoint dict for mbox, or None."""
+        return self.db.get(self._key(mbox))
+
+    def make_point(self, fp, offset, nmessages, last=None):
+        """
+        The checkpoint for the mbox open as fp, indexed up to byte
+        offset, where last is the Q-term of the message starting there
+        (if we've seen it already). Take this while the file we indexed
+        is still open, so that it describes what we read, not whatever
+        is there by the time set() gets to record it.
+        """
+        st = os.fstat(fp.fileno())
+        return { 'offset': offset,
+                 'count': nmessages,
+                 'last': last,
+                 'size': st.st_size,
+                 'mtime': st.st_mtime,
+                 'fingerprint': self.fingerprint(fp, offset) }
+
+    def set(self, mbox, point):
+        """Record point, from make_point(), as mbox's checkpoint."""
+        self.db[self._key(mbox)] = point
+        self.db.sync()
+
+    def forget(self, mbox):
+        try:
+            del self.db[self._key(mbox)]
+        except KeyError:
+            pass
+
+    def mboxes(self):
+        """The (absolute) paths of all the mboxes we have checkpoints for."""
+        return self.db.keys()
+
+    def is_valid(self, mbox, point):
+        """
+        Is point still a valid place to resume mbox from? It isn't if
+        the file has shrunk below the offset, or the bytes before the
+        offset have changed.
+        """
+        fp = file(mbox, 'rb')
+        try:
+            size = os.fstat(fp.fileno()).st_size
+            if size < point['offset']:
+                return False
+            return self.fingerprint(fp, point['offset'])==point['fingerprint']
+        finally:
+            fp.close()
+
+    def fingerprint(self, fp, offset):
+        """
+        Hash the first and last FINGERPRINT_LENGTH bytes before offset;
+        enough to notice an edited mbox without reading all of it.
+        """
+        h = md5.new(str(offset))
+        fp.seek(0)
+        h.update(fp.read(min(offset, self.FINGERPRINT_LENGTH)))
+        start = max(0, offset - self.FINGERPRINT_LENGTH)
+        fp.seek(start)
+        h.update(fp.read(offset - start))
+        return h.hexdigest()
+
+    def close(self):
+        self.db.close()
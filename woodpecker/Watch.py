@@ -0,0 +1,165 @@
+# Woodpecker watch daemon
+#
+# (c) Copyright James Aylett 2008
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+"""
+Keep the index up to date as mail arrives, from one long-running
+process holding the database open.
+
+With pyinotify available we're told about changes to mboxes and
+Maildirs as they happen; otherwise we fall back to re-checking
+everything every so often (which is cheap, thanks to mbox checkpoints
+and Maildir manifests). Either way, changes are collected until
+things have been quiet for a few seconds, then indexed together and
+committed as one batch (unless there's a commit policy, which still
+commits as often as it says).
+"""
+
+import os, time
+import woodpecker.Maildir
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+class Watcher:
+    """
+    Watches by polling: wait() just says everything has changed, every
+    interval seconds. Subclasses that can be told about changes
+    override wait(), which blocks for up to timeout seconds (or
+    forever, if it's None) and returns any mailboxes that have changed.
+    """
+    def __init__(self, pecker, paths, debounce=5, max_delay=60, interval=60):
+        self.pecker = pecker
+        self.paths = paths
+        self.debounce = debounce # wait for this long without changes
+        self.max_delay = max_delay # but never put off indexing longer
+        self.interval = interval
+        self.last = time.time()
+
+    def wait(self, timeout):
+        if timeout!=None:
+            # everything's already dirty; no point waiting for more
+            return {}
+        delay = self.last + self.interval - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self.last = time.time()
+        dirty = {}
+        for path in self.paths:
+            dirty[path] = True
+        return dirty
+
+    def run(self):
+        # the first time through can be big, so commit as usual...
+        self.pecker.index_mailbox(self.paths)
+        self.pecker.commit()
+        # ...but after that, each batch in one go (unless there's a
+        # commit policy, which still has its say)
+        self.pecker.batching = True
+        try:
+            while True:
+                dirty = self.wait(None)
+                if not dirty:
+                    continue
+                first = time.time()
+                while time.time() - first < self.max_delay:
+                    more = self.wait(self.debounce)
+                    if not more:
+                        break
+                    dirty.update(more)
+                self.index(dirty)
+        except KeyboardInterrupt:
+            pass
+
+    def index(self, dirty):
+        targets = dirty.keys()
+        targets.sort()
+        for path in targets:
+            if not os.path.exists(path):
+                continue
+            try:
+                self.pecker.index_mailbox(path)
+            except KeyboardInterrupt:
+                raise
+            except:
+                self.pecker.failed('mailbox')
+        # and clear out any of them, or anything under them, that's gone
+        # (unless what we're watching has gone altogether)
+        self.pecker.sweep_missing(targets, self.paths)
+        self.pecker.commit()
+
+if pyinotify!=None:
+    class _Collector(pyinotify.ProcessEvent):
+        def __init__(self, watcher):
+            pyinotify.ProcessEvent.__init__(self)
+            self.watcher = watcher
+
+        def process_default(self, event):
+            target = self.watcher.target(event.pathname)
+            if target!=None:
+                self.watcher.dirty[target] = True
+
+    class InotifyWatcher(Watcher):
+        MASK = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MODIFY |
+                pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM |
+                pyinotify.IN_CREATE | pyinotify.IN_DELETE)
+
+        def __init__(self, pecker, paths, debounce=5, max_delay=60):
+            Watcher.__init__(self, pecker, paths, debounce, max_delay)
+            self.dirty = {}
+            self.wm = pyinotify.WatchManager()
+            self.notifier = pyinotify.Notifier(self.wm, _Collector(self))
+            for path in paths:
+                self.wm.add_watch(path, self.MASK, rec=True, auto_add=True)
+
+        def target(self, path):
+            """
+            The mailbox a change to path affects: the mbox itself, or the
+            Maildir a message file is in. None if it's nothing of ours.
+            """
+            parent = os.path.dirname(path)
+            if os.path.basename(parent) in ('cur', 'new', 'tmp'):
+                maildir = os.path.dirname(parent)
+                if woodpecker.Maildir.is_maildir(maildir):
+                    if os.path.basename(parent)=='tmp':
+                        # still being delivered
+                        return None
+                    return maildir
+            if os.path.basename(path).startswith('.') and not os.path.isdir(path):
+                # lock files and the like
+                return None
+            return path
+
+        def wait(self, timeout):
+            if timeout!=None:
+                timeout = int(timeout * 1000)
+            if self.notifier.check_events(timeout):
+                self.notifier.read_events()
+                self.notifier.process_events()
+            dirty = self.dirty
+            self.dirty = {}
+            return dirty
+
+def make_watcher(pecker, paths, debounce=5, max_delay=60, interval=60):
+    """Get the best watcher we can for paths."""
+    if pyinotify!=None:
+        return InotifyWatcher(pecker, paths, debounce, max_delay)
+    pecker.logger.log("pyinotify not available; checking for changes every %is.\n", interval)
+    return Watcher(pecker, paths, debounce, max_delay, interval)
@@ -19,20 +19,33 @@
 
 """
 Woodpecker is a reasonably lightweight personal email search system.
-Throw it at all your mboxes, and you end up with a Xapian database
-that you can search quickly. Re-run over mboxes and everything works,
-providing you don't delete emails (so it'll cope with emails being
-moved from mbox to mbox at low cost).
+Throw it at all your mboxes and Maildirs, and you end up with a Xapian database
+that you can search quickly. Re-run over mboxes and everything works:
+emails moved from mbox to mbox are picked up at low cost, and emails
+(or whole mboxes) that have been deleted drop out of the index (though
+not if a path you gave it has gone altogether, unless you say so with
+--forget-missing).
 
-The search interface is pretty limited. Indexing currently copes with
-text/plain and text/html (needs elinks); message processing copes with
-multipart.
+The search interface is pretty limited, but server.py will answer
+queries from other programs as JSON. Indexing currently copes with
+text/plain and text/html (converted in-process, or optionally with
+elinks); message processing copes with multipart.
 """
 
-__all__ = ['Indexer', 'Utils']
+__all__ = ['Attachments', 'Benchmark', 'Data', 'HTML', 'Indexer', 'Maildir', 'Maintenance',
+           'MBox', 'Search', 'Server', 'Shards', 'Stats', 'Threads', 'Utils', 'Watch']
 
 VERSION = '0.1'
 
+# Document value slots
+VALUE_UTCDATETIME = 0 # as serialised float
+VALUE_UTCDATE = 1 # as YYYYMMDD
+VALUE_FINGERPRINT = 2 # md5 of the raw message
+VALUE_OFFSET = 3 # byte offset of the message in its mbox, in decimal
+VALUE_LENGTH = 4 # length of the message in bytes, in decimal
+VALUE_THREAD = 5 # thread id (also as an XTHREAD term)
+VALUE_BUILD = 6 # what built the document; see Indexer.DocumentBuilder
+
 import os, os.path, pwd, xapian
 
 class WoodpeckerError(RuntimeError):
@@ -61,16 +74,81 @@ class Config:
 
         self.configpath = configpath
         self.dbpath = os.path.join(self.configpath, 'index')
+        self.checkpointpath = os.path.join(self.configpath, 'checkpoints')
+        self.threadpath = os.path.join(self.configpath, 'threads')
+        self.manifestpath = os.path.join(self.configpath, 'maildirs')
+        self.attachmentpath = os.path.join(self.configpath, 'attachments')
+        self.socketpath = os.path.join(self.configpath, 'socket')
         self.language = 'english' # FIXME: noooo! :-)
+        self.html_converter = 'builtin' # or 'elinks'
+        html_converter = self._read_list('html-converter') # see HTML
+        if html_converter:
+            self.html_converter = html_converter[0]
+        self.data_format = 'binary' # or 'json'
+        self.progress_interval = 60 # seconds between progress lines, or None
+        self.statspath = None # where to write indexing stats, if anywhere
+        self.forget_missing = False # drop what we had from paths we're given that have gone
+        self.my_addresses = self._read_list('addresses')
+        self.extract_attachments = True
+        self.extractors = self._read_list('extractors') # see Attachments
+        self.attachment_jobs = 2 # worker processes for extraction
+        self.attachment_timeout = None # or seconds, for every extractor
+        self.shardpath = os.path.join(self.configpath, 'shards')
+        sharding = self._read_list('sharding') # see Shards
+        self.sharding = None
+        if sharding:
+            self.sharding = sharding[0]
+        self.shard_groups = self._read_list('shard-groups')
+
+    def _read_list(self, name):
+        """Read a config file with one entry per line, if it's there."""
+        path = os.path.join(self.configpath, name)
+        if not os.path.exists(path):
+            return []
+        fp = file(path)
+        try:
+            return [ l.strip() for l in fp.readlines() if l.strip()!='' ]
+        finally:
+            fp.close()
+
+    def get_shard_dir(self, shard):
+        """Where a shard keeps its database and indexing state."""
+        return os.path.join(self.shardpath, shard)
+
+    def get_shards(self):
+        """The names of the shards that have been built, in order."""
+        if not os.path.isdir(self.shardpath):
+            return []
+        names = [ name for name in os.listdir(self.shardpath) if os.path.isdir(os.path.join(self.shardpath, name, 'index')) ]
+        names.sort()
+        return names
 
-    def get_writeable_index(self):
-        """Get a xapian.Database that is writable for the email index."""
-        return xapian.WritableDatabase(self.dbpath, xapian.DB_CREATE_OR_OPEN)
+    def get_writeable_index(self, shard=None):
+        """
+        Get a xapian.Database that is writable for the email index, or
+        for one shard of it.
+        """
+        if shard==None:
+            return xapian.WritableDatabase(self.dbpath, xapian.DB_CREATE_OR_OPEN)
+        path = self.get_shard_dir(shard)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return xapian.WritableDatabase(os.path.join(path, 'index'), xapian.DB_CREATE_OR_OPEN)
     get_writable_index = get_writeable_index
 
-    def get_index(self):
-        """Get a xapian.Database for the email index."""
-        return xapian.Database(self.dbpath)
+    def get_index(self, shards=None):
+        """
+        Get a xapian.Database for the email index. If it's sharded, that's
+        all the shards (or just the ones named) searched as one.
+        """
+        if self.sharding==None and shards==None:
+            return xapian.Database(self.dbpath)
+        if shards==None:
+            shards = self.get_shards()
+        database = xapian.Database()
+        for shard in shards:
+            database.add_database(xapian.Database(os.path.join(self.get_shard_dir(shard), 'index')))
+        return database
 
     def get_language(self):
         """Get the language we're running in (default: English)."""